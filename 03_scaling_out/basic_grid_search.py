@@ -14,36 +14,101 @@ stub = modal.Stub(
     image=modal.Image.debian_slim().pip_install("scikit-learn~=1.2.2"),
 )
 
-# ## The Modal function
+# The grid we search over, and how many values of `k` each call evaluates.
+# Handing a worker several values at once amortizes the per-call overhead,
+# and lets it reuse everything it has already computed for the chunk.
+
+K_VALUES = list(range(1, 100))
+CHUNK_SIZE = 10
+
+# ## The Modal class
+#
+# Next, define the search engine. Note that we use the custom image with scikit-learn in it.
 #
-# Next, define the function. Note that we use the custom image with scikit-learn in it.
-# We also take the hyperparameter `k`, which is how many nearest neighbors we use.
+# Rather than a plain function that reloads `load_digits` and recomputes the
+# `train_test_split` on every call, we use a class: the dataset is loaded and split
+# once per container in `__enter__`, and every call routed to that container reuses it.
+#
+# For k-nearest-neighbors specifically, we don't need a fresh fit for every `k` either.
+# The neighbor graph at the largest `k` already contains the sorted neighbors for every
+# smaller `k`, so we compute it once and score each `k` by a majority vote over its
+# first `k` columns. A running count of votes per class over those columns gives us the
+# predictions for every `k` in a single vectorized pass. Ties go to the smallest label,
+# just like `KNeighborsClassifier`.
+
 
+@stub.cls()
+class KNNGridSearch:
+    def __enter__(self):
+        from sklearn.datasets import load_digits
+        from sklearn.model_selection import train_test_split
 
-@stub.function()
-def fit_knn(k):
-    from sklearn.datasets import load_digits
-    from sklearn.model_selection import train_test_split
-    from sklearn.neighbors import KNeighborsClassifier
+        X, y = load_digits(return_X_y=True)
+        (
+            self.X_train,
+            self.X_test,
+            self.y_train,
+            self.y_test,
+        ) = train_test_split(X, y, random_state=42)
+        self.n_classes = int(y.max()) + 1
+        self.accuracies = None  # accuracy for every k up to the graph size
 
-    X, y = load_digits(return_X_y=True)
-    X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=42)
+    def _accuracies(self, max_k):
+        import numpy as np
+        from sklearn.neighbors import NearestNeighbors
 
-    clf = KNeighborsClassifier(k)
-    clf.fit(X_train, y_train)
-    score = float(clf.score(X_test, y_test))
-    print("k = %3d, score = %.4f" % (k, score))
-    return score, k
+        if self.accuracies is None or len(self.accuracies) < max_k:
+            nn = NearestNeighbors(n_neighbors=max_k).fit(self.X_train)
+            _, indices = nn.kneighbors(self.X_test)  # sorted by distance
+            neighbor_labels = self.y_train[indices]  # (n_test, max_k)
+            votes = np.cumsum(np.eye(self.n_classes)[neighbor_labels], axis=1)
+            predictions = votes.argmax(axis=2)  # (n_test, max_k)
+            self.accuracies = (predictions == self.y_test[:, None]).mean(axis=0)
+        return self.accuracies
+
+    @modal.method()
+    def fit_knn(self, ks, max_k=None):
+        accuracies = self._accuracies(max_k or max(ks))
+        results = []
+        for k in ks:
+            score = float(accuracies[k - 1])
+            print("k = %3d, score = %.4f" % (k, score))
+            results.append((score, k))
+        return results
 
 
 # ## Parallel search
 #
-# To do a hyperparameter search, let's map over this function with different values
-# for `k`, and then select for the best score on the holdout set:
+# To do a hyperparameter search, let's map over chunks of `k` values, and then select
+# for the best score on the holdout set. We pass the largest `k` in the whole grid along
+# with every chunk, so a container that picks up several chunks only builds the
+# neighbor graph once.
+#
+# Results stream back in completion order with `order_outputs=False`, so we can act on
+# them as they finish. If `patience` chunks in a row come back without improving on
+# the best score, we stop early and the remaining inputs are cancelled.
+
+
+def chunked(values, size):
+    return [values[i : i + size] for i in range(0, len(values), size)]
 
 
 @stub.local_entrypoint()
-def main():
-    # Do a basic hyperparameter search
-    best_score, best_k = max(fit_knn.map(range(1, 100)))
+def main(patience: int = 0):
+    best_score, best_k = 0.0, None
+    since_improvement = 0
+    for results in KNNGridSearch().fit_knn.map(
+        chunked(K_VALUES, CHUNK_SIZE),
+        kwargs={"max_k": max(K_VALUES)},
+        order_outputs=False,
+    ):
+        chunk_best = max(results)
+        if chunk_best > (best_score, best_k or 0):
+            best_score, best_k = chunk_best
+            since_improvement = 0
+        else:
+            since_improvement += 1
+        if patience and since_improvement >= patience:
+            print("No improvement in %d chunks, stopping early" % patience)
+            break
     print("Best k = %3d, score = %.4f" % (best_k, best_score))
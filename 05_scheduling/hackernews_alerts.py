@@ -18,9 +18,36 @@ import modal
 stub = modal.Stub("example-hn-bot")
 
 # Now, let's define an image that has the `slack-sdk` package installed, in which we can run a function
-# that posts a slack message.
+# that posts a slack message. We also install `aiohttp`, which `slack-sdk` uses for its async client.
+
+slack_sdk_image = modal.Image.debian_slim().pip_install("slack-sdk", "aiohttp")
+
+# We don't want to post the same story again on every run while it's still inside the search window,
+# so we remember the IDs of the stories we've already posted, and when we posted them, in a persisted
+# [`Dict`](/docs/reference/modal.Dict). They're all kept under a single key, so each run fetches them
+# in one call.
+
+stub.posted_stories = modal.Dict.persisted("example-hn-bot-posted-stories")
+POSTED_KEY = "posted"
+
+# Both API endpoints can be overridden by setting the `HN_SEARCH_URL` and `SLACK_API_URL` environment
+# variables when running the app, which makes it easy to point the bot at local stub servers while
+# developing. Environment variables on your machine don't reach the containers, so we pass any
+# overrides along in a [`Secret`](/docs/reference/modal.Secret), and read them inside the functions.
+
+DEFAULT_URLS = {
+    "HN_SEARCH_URL": "http://hn.algolia.com/api/v1/search",
+    "SLACK_API_URL": "https://www.slack.com/api/",
+}
+
+url_overrides = modal.Secret.from_dict(
+    {name: os.environ[name] for name in DEFAULT_URLS if name in os.environ}
+)
+
+
+def api_url(name: str) -> str:
+    return os.environ.get(name, DEFAULT_URLS[name])
 
-slack_sdk_image = modal.Image.debian_slim().pip_install("slack-sdk")
 
 # ## Defining the function and importing the secret
 #
@@ -29,18 +56,75 @@ slack_sdk_image = modal.Image.debian_slim().pip_install("slack-sdk")
 # from the list options, and follow the instructions in the "Where to find the credentials?" panel.
 # Name your secret `hn-bot-slack`, so that the code in this example still works.
 #
-# Now, we define the function `post_to_slack`, which simply instantiates the Slack client using our token,
-# and then uses it to post a message to a given channel name.
+# Now, we define the function `post_to_slack`, which takes all of the new stories from a run and posts them
+# to a given channel name as a single [Block Kit](https://api.slack.com/block-kit) message. Slack allows at
+# most 50 blocks per message, so a very busy day is split over as few messages as possible.
+#
+# All messages go through one async client sharing one pool of connections. If Slack tells us we're
+# being rate limited, the client's retry handler waits for the `Retry-After` period and tries again.
+
+MAX_BLOCKS_PER_MESSAGE = 50
+
+
+# Slack's mrkdwn treats `&`, `<` and `>` as control characters, so they must be escaped in titles,
+# or a title containing them would break the link.
+def slack_escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def story_blocks(stories: list[dict]) -> list[list[dict]]:
+    per_message = MAX_BLOCKS_PER_MESSAGE - 1  # leave room for the header
+    messages = []
+    for i in range(0, len(stories), per_message):
+        blocks = [
+            {
+                "type": "header",
+                "text": {
+                    "type": "plain_text",
+                    "text": f"New '{QUERY}' stories",
+                },
+            }
+        ]
+        for story in stories[i : i + per_message]:
+            blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": f"<{story['url']}|{slack_escape(story['title'])}>",
+                    },
+                }
+            )
+        messages.append(blocks)
+    return messages
 
 
 @stub.function(
-    image=slack_sdk_image, secret=modal.Secret.from_name("hn-bot-slack")
+    image=slack_sdk_image,
+    secrets=[modal.Secret.from_name("hn-bot-slack"), url_overrides],
 )
-async def post_to_slack(message: str):
-    import slack_sdk
-
-    client = slack_sdk.WebClient(token=os.environ["SLACK_BOT_TOKEN"])
-    client.chat_postMessage(channel="hn-alerts", text=message)
+async def post_to_slack(stories: list[dict]):
+    import aiohttp
+    from slack_sdk.http_retry.builtin_async_handlers import (
+        AsyncRateLimitErrorRetryHandler,
+    )
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    async with aiohttp.ClientSession() as session:
+        client = AsyncWebClient(
+            token=os.environ["SLACK_BOT_TOKEN"],
+            base_url=api_url("SLACK_API_URL"),
+            session=session,
+        )
+        client.retry_handlers.append(
+            AsyncRateLimitErrorRetryHandler(max_retry_count=5)
+        )
+        for blocks in story_blocks(stories):
+            await client.chat_postMessage(
+                channel="hn-alerts",
+                text=f"{len(blocks) - 1} new '{QUERY}' stories",
+                blocks=blocks,
+            )
 
 
 # ## Searching Hacker News
@@ -50,35 +134,68 @@ async def post_to_slack(message: str):
 
 QUERY = "serverless"
 WINDOW_SIZE_DAYS = 1
+HITS_PER_PAGE = 100
 
 # Let's also define an image that has the `requests` package installed, so we can query the API.
 
 requests_image = modal.Image.debian_slim().pip_install("requests")
 
 # We can now define our main entrypoint, that queries Algolia for the term, and calls `post_to_slack`
-# on all the results. We specify a [schedule](/docs/guide/cron) in the function decorator, which
-# means that our function will run automatically at the given interval.
+# once with all of the results we haven't posted before. The search API returns results a page at a
+# time, so we keep requesting pages over one HTTP session until we've seen all of them.
+#
+# Stories are only marked as posted once `post_to_slack` has succeeded, so a failed run will retry
+# them the next day. A story posted before the start of the search window can't show up in the results
+# again, so we forget it then, which keeps the set of posted stories from growing forever.
 
 
-@stub.function(image=requests_image)
+@stub.function(image=requests_image, secret=url_overrides)
 def search_hackernews():
     import requests
 
-    url = "http://hn.algolia.com/api/v1/search"
-
     threshold = datetime.utcnow() - timedelta(days=WINDOW_SIZE_DAYS)
 
     params = {
         "query": QUERY,
         "numericFilters": f"created_at_i>{threshold.timestamp()}",
+        "hitsPerPage": HITS_PER_PAGE,
+    }
+
+    hits = []
+    with requests.Session() as session:
+        page, num_pages = 0, 1
+        while page < num_pages:
+            params["page"] = page
+            response = session.get(
+                api_url("HN_SEARCH_URL"), params=params, timeout=10
+            ).json()
+            hits.extend(response["hits"])
+            num_pages = response["nbPages"]
+            page += 1
+
+    try:
+        posted = stub.posted_stories.get(POSTED_KEY)
+    except KeyError:
+        posted = {}
+    posted = {
+        id: posted_at
+        for id, posted_at in posted.items()
+        if posted_at > threshold.timestamp()
     }
 
-    response = requests.get(url, params, timeout=10).json()
-    urls = [item["url"] for item in response["hits"] if item.get("url")]
+    stories = [
+        {"id": item["objectID"], "title": item["title"], "url": item["url"]}
+        for item in hits
+        if item.get("url") and item["objectID"] not in posted
+    ]
 
-    print(f"Query returned {len(urls)} items.")
+    print(f"Query returned {len(hits)} items, {len(stories)} new.")
 
-    post_to_slack.for_each(urls)
+    if stories:
+        post_to_slack.remote(stories)
+        posted_at = datetime.utcnow().timestamp()
+        posted.update({story["id"]: posted_at for story in stories})
+    stub.posted_stories.put(POSTED_KEY, posted)
 
 
 # ## Test running
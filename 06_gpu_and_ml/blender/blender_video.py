@@ -9,8 +9,11 @@
 
 # ## Basic setup
 
+import io
 import os
 import tempfile
+from dataclasses import dataclass
+from typing import Iterable, Iterator
 
 import modal
 
@@ -25,6 +28,8 @@ MATERIALS_FILENAME = (
 
 START_FRAME = 32
 END_FRAME = 34
+WIDTH = 400
+HEIGHT = 400
 
 # ## Defining the image
 #
@@ -103,66 +108,224 @@ if stub.is_inside():
     bpy.data.scenes[0].cycles.samples = 200
 
 
+# ## Render settings
+#
+# Final renders use 200 samples per pixel. For a quick preview, we can render with
+# far fewer samples, and turn on Cycles' adaptive sampling, which stops sampling
+# pixels early once their noise is below a threshold.
+
+
+@dataclass(frozen=True)
+class RenderSettings:
+    samples: int = 200
+    adaptive_threshold: float = 0.0  # 0 disables adaptive sampling
+
+
+PREVIEW = RenderSettings(samples=32, adaptive_threshold=0.05)
+
+
+# ## Splitting frames into tiles
+#
+# Rendering one frame per GPU leaves most workers idle when there are only a few
+# frames. Instead, we can split each frame into a grid of tiles and render every
+# tile on its own worker, using Blender's border rendering, which renders only a
+# region of the frame and crops the output to it.
+#
+# Tiles are given as pixel boxes, `(left, top, right, bottom)` like PIL uses, so
+# that neighbouring tiles meet exactly, whatever the resolution.
+
+
+def tile_boxes(
+    width: int, height: int, tiles_x: int, tiles_y: int
+) -> list[tuple[int, int, int, int]]:
+    xs = [width * i // tiles_x for i in range(tiles_x + 1)]
+    ys = [height * j // tiles_y for j in range(tiles_y + 1)]
+    return [
+        (xs[i], ys[j], xs[i + 1], ys[j + 1])
+        for j in range(tiles_y)
+        for i in range(tiles_x)
+    ]
+
+
 # ## Use a GPU from a Modal function
 #
-# Now, let's define the function that renders each frame in parallel.
+# Now, let's define the function that renders each tile in parallel.
 # Note the `gpu="any"` argument which tells Modal to use GPU workers.
+#
+# Blender measures the border from the bottom left corner, as a fraction of the
+# frame, so we convert the tile's pixel box before rendering.
 
 
 @stub.function(gpu="t4")
-def render_frame(i):
-    print(f"Using frame {i}")
+def render_tile(
+    i: int, box: tuple[int, int, int, int], settings: RenderSettings
+):
+    print(f"Using frame {i}, tile {box}")
 
     scn = bpy.context.scene
-    scn.render.resolution_x = 400
-    scn.render.resolution_y = 400
+    scn.render.resolution_x = WIDTH
+    scn.render.resolution_y = HEIGHT
     scn.render.resolution_percentage = 100
+    scn.cycles.samples = settings.samples
+    scn.cycles.use_adaptive_sampling = settings.adaptive_threshold > 0
+    scn.cycles.adaptive_threshold = settings.adaptive_threshold
     scn.frame_set(i)
 
+    left, top, right, bottom = box
+    scn.render.use_border = True
+    scn.render.use_crop_to_border = True
+    scn.render.border_min_x = left / WIDTH
+    scn.render.border_max_x = right / WIDTH
+    scn.render.border_min_y = 1 - bottom / HEIGHT
+    scn.render.border_max_y = 1 - top / HEIGHT
+
     with tempfile.NamedTemporaryFile(suffix=".png") as tf:
         scn.render.filepath = tf.name
         # Render still frame
         bpy.ops.render.render(write_still=True)
         with open(tf.name, "rb") as image:
-            img_bytes = bytearray(image.read())
-            return i, img_bytes
+            return i, box, image.read()
+
+
+# ## Reassembling frames
+#
+# Tiles come back in whatever order they finish. `assemble_frames` pastes each
+# tile into its frame, and yields every frame as soon as its last tile is in, so
+# frames too come out in the order they finish.
+#
+# An animation needs its frames in order, so `in_order` holds back frames that
+# finish early until the frames before them are done.
+
+
+def assemble_frames(
+    tiles: Iterable[tuple[int, tuple[int, int, int, int], bytes]],
+    num_tiles: int,
+    width: int = WIDTH,
+    height: int = HEIGHT,
+) -> Iterator[tuple]:
+    from PIL import Image
+
+    frames: dict = {}
+    tiles_left: dict = {}
+    for i, box, png in tiles:
+        if i not in frames:
+            frames[i] = Image.new("RGBA", (width, height))
+            tiles_left[i] = num_tiles
+        frames[i].paste(Image.open(io.BytesIO(png)), box[:2])
+        tiles_left[i] -= 1
+        if tiles_left[i] == 0:
+            del tiles_left[i]
+            yield i, frames.pop(i)
+
+
+def in_order(frames: Iterable[tuple], first: int) -> Iterator[tuple]:
+    waiting: dict = {}
+    for i, frame in frames:
+        waiting[i] = frame
+        while first in waiting:
+            yield first, waiting.pop(first)
+            first += 1
 
 
 # ## Entrypoint
 #
 # The code that gets run locally.
 # Note that it doesn't require Blender present to run it.
-# In order to render in parallel, we use the `.map` method on the `render_frame` function.
+# In order to render in parallel, we use the `.starmap` method on the `render_tile` function,
+# with one input for every tile of every frame.
 # This spins up as many workers as are needed—as
-# many as one for each frame, doing everything in parallel.
+# many as one for each tile, doing everything in parallel.
+#
+# With `order_outputs=False`, tiles stream back as soon as they are rendered. We
+# save each frame as soon as it is complete, and feed the frames, in order, straight
+# into the GIF encoder, rather than writing them all out and reading them back in.
 
 
 OUTPUT_DIR = "/tmp/render"
 
 
+def save_animation(frames: Iterator, output_dir: str):
+    def saved_frames():
+        for i, frame in frames:
+            frame.save(os.path.join(output_dir, f"scene_{i:03}.png"))
+            print(f"Saved frame {i}")
+            yield frame
+
+    frames_iter = saved_frames()
+    first = next(frames_iter)
+    first.save(
+        fp=os.path.join(output_dir, "scene.gif"),
+        format="GIF",
+        append_images=frames_iter,
+        save_all=True,
+        duration=200,
+        loop=0,
+    )
+
+
 @stub.local_entrypoint()
-def main():
+def main(tiles: int = 1, preview: bool = False, self_test: bool = False):
+    if self_test:
+        test_tiling(max(tiles, 3))
+        return
+
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    # Render the frames in parallel using modal, and write them to disk.
-    for idx, frame in render_frame.map(range(START_FRAME, END_FRAME + 1)):
-        with open(os.path.join(OUTPUT_DIR, f"scene_{idx:03}.png"), "wb") as f:
-            f.write(frame)
+    settings = PREVIEW if preview else RenderSettings()
+    boxes = tile_boxes(WIDTH, HEIGHT, tiles, tiles)
+    jobs = [
+        (i, box, settings)
+        for i in range(START_FRAME, END_FRAME + 1)
+        for box in boxes
+    ]
+    rendered = render_tile.starmap(jobs, order_outputs=False)
+    frames = assemble_frames(rendered, len(boxes))
+    save_animation(in_order(frames, START_FRAME), OUTPUT_DIR)
+
+
+# ## Testing without Blender
+#
+# `modal run blender_video.py --self-test` runs the tiling, reassembly and
+# animation encoding locally, with a fake renderer that draws a synthetic image
+# for each frame and returns its tiles in a shuffled order.
 
-    # Stitch together frames into a gif.
-    import glob
 
+def fake_frame(i: int):
     from PIL import Image
 
-    img, *imgs = [
-        Image.open(f)
-        for f in sorted(glob.glob(os.path.join(OUTPUT_DIR, "scene*.png")))
-    ]
-    img.save(
-        fp=os.path.join(OUTPUT_DIR, "scene.gif"),
-        format="GIF",
-        append_images=imgs,
-        save_all=True,
-        duration=200,
-        loop=0,
+    frame = Image.new("RGBA", (WIDTH, HEIGHT))
+    frame.putdata(
+        [
+            (x % 256, y % 256, (i * 40) % 256, 255)
+            for y in range(HEIGHT)
+            for x in range(WIDTH)
+        ]
     )
+    return frame
+
+
+def fake_render_tile(i: int, box: tuple[int, int, int, int], settings):
+    with io.BytesIO() as buf:
+        fake_frame(i).crop(box).save(buf, format="PNG")
+        return i, box, buf.getvalue()
+
+
+def test_tiling(tiles: int):
+    import random
+
+    boxes = tile_boxes(WIDTH, HEIGHT, tiles, tiles + 1)
+    jobs = [
+        (i, box, RenderSettings())
+        for i in range(START_FRAME, END_FRAME + 1)
+        for box in boxes
+    ]
+    random.shuffle(jobs)
+    rendered = (fake_render_tile(*job) for job in jobs)
+    frames = list(in_order(assemble_frames(rendered, len(boxes)), START_FRAME))
+    assert [i for i, _ in frames] == list(range(START_FRAME, END_FRAME + 1))
+    for i, frame in frames:
+        assert frame.tobytes() == fake_frame(i).tobytes(), f"frame {i} differs"
+
+    output_dir = tempfile.mkdtemp()
+    save_animation(iter(frames), output_dir)
+    print(f"Reassembled {len(frames)} frames from {len(boxes)} tiles each")
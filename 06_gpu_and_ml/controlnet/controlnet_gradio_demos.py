@@ -18,20 +18,29 @@
 #
 # ## Imports and config preamble
 
+import collections
+import hashlib
 import importlib
-import os
+import json
 import pathlib
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
+from typing import Callable, Optional
 
 from fastapi import FastAPI
-from modal import Image, Secret, Stub, asgi_app
+from fastapi.responses import HTMLResponse
+from modal import Image, Stub, asgi_app
 
 # Below are the configuration objects for all **10** demos provided in the original [lllyasviel/ControlNet](https://github.com/lllyasviel/ControlNet) repo.
 # The demos each depend on their own custom pretrained StableDiffusion model, and these models are 5-6GB each.
-# We can only run one demo at a time, so this module avoids downloading the model and 'detector' dependencies for
-# all 10 demos and instead uses the demo configuration object to download only what's necessary for the chosen demo.
 #
-# Even just limiting our dependencies setup to what's required for one demo, the resulting container image is *huge*.
+# Most of each of those checkpoints is the same StableDiffusion 1.5 backbone, though: ControlNet
+# keeps the backbone locked while it trains, and only learns the weights of its control network.
+# So rather than keeping ten full copies, we keep the backbone once, and just the control network
+# weights of each checkpoint. That lets us serve all 10 demos from a single GPU.
 
 
 @dataclass(frozen=True)
@@ -42,6 +51,11 @@ class DemoApp:
     model_files: list[str]
     detector_files: list[str] = field(default_factory=list)
 
+    @property
+    def control_name(self) -> str:
+        """Name of the control network, which several demos may share."""
+        return pathlib.Path(self.model_files[0]).stem
+
 
 demos = [
     DemoApp(
@@ -127,14 +141,6 @@ demos = [
 ]
 demos_map: dict[str, DemoApp] = {d.name: d for d in demos}
 
-# ## Pick a demo, any demo
-#
-# Simply by changing the `DEMO_NAME` below, you can change which ControlNet demo app is setup
-# and run by this Modal script.
-
-DEMO_NAME = "scribble2image"  # Change this value to change the active demo app.
-selected_demo = demos_map[DEMO_NAME]
-
 # ## Setting up the dependencies
 #
 # ControlNet requires *a lot* of dependencies which could be fiddly to setup manually, but Modal's programmatic
@@ -146,7 +152,7 @@ selected_demo = demos_map[DEMO_NAME]
 # 2. a bunch of third party PyPi packages
 # 3. `git`, so that we can download the ControlNet source code (there's no `controlnet` PyPi package)
 # 4. some image process Linux system packages, including `ffmpeg`
-# 5. and demo specific pre-trained model and detector `.pth` files
+# 5. and the pre-trained model and detector `.pth` files of every demo
 #
 # That's a lot! Fortunately, the code below is already written for you that stitches together a working container image
 # ready to produce remarkable ControlNet images.
@@ -154,23 +160,238 @@ selected_demo = demos_map[DEMO_NAME]
 # **Note:** a ControlNet model pipeline is [now available in Huggingface's `diffusers` package](https://huggingface.co/blog/controlnet). But this does not contain the demo apps.
 
 
-def download_file(url: str, output_path: pathlib.Path):
+# ### Downloading the files
+#
+# The checkpoints add up to tens of gigabytes, so `download_file` tries to make the
+# most of the network, and to never download a byte twice:
+#
+# * A file is split into `segments` byte ranges that are downloaded in parallel, over
+#   HTTP range requests, into a `.part` file. (Servers that don't support ranges get a
+#   single stream.)
+# * A small `.progress` file next to it records how far each segment got, so that
+#   if a connection drops, or the whole build restarts, downloading picks up where it
+#   left off. Failed segments are retried with backoff.
+# * The sha256 of the file is computed while it downloads, over the prefix of the file
+#   that is complete so far. Hugging Face tells us the hash of the files it hosts in an
+#   `X-Linked-Etag` header, so we usually know what to expect, and a file that is already
+#   in place with the right hash isn't downloaded again.
+#
+# `download_files` downloads several files at once.
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+def file_sha256(path: pathlib.Path, limit: Optional[int] = None):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = DOWNLOAD_CHUNK_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            chunk = f.read(size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest
+
+
+def expected_sha256(response) -> Optional[str]:
+    for r in [*response.history, response]:
+        etag = r.headers.get("X-Linked-Etag", "").strip('"')
+        if re.fullmatch("[0-9a-f]{64}", etag):
+            return etag
+    return None
+
+
+class SegmentedDownload:
+    def __init__(
+        self, url: str, part_path: pathlib.Path, size: int, segments: int
+    ):
+        self.url = url
+        self.part_path = part_path
+        self.progress_path = part_path.with_suffix(".progress")
+        bounds = [size * i // segments for i in range(segments + 1)]
+        self.ranges = list(zip(bounds, bounds[1:]))
+        self.done = [0] * segments
+        if not self.resume():
+            with open(self.part_path, "wb") as f:
+                f.truncate(size)
+        self.lock = threading.Lock()
+        self.hashed = self.complete_prefix()
+        self.digest = file_sha256(self.part_path, limit=self.hashed)
+
+    def resume(self) -> bool:
+        if not (self.part_path.exists() and self.progress_path.exists()):
+            return False
+        progress = json.loads(self.progress_path.read_text())
+        if progress["url"] != self.url or progress["ranges"] != [
+            list(r) for r in self.ranges
+        ]:
+            return False
+        self.done = progress["done"]
+        return True
+
+    def complete_prefix(self) -> int:
+        prefix = 0
+        for (start, end), done in zip(self.ranges, self.done):
+            prefix = start + done
+            if start + done < end:
+                break
+        return prefix
+
+    def record(self, segment: int, num_bytes: int):
+        with self.lock:
+            self.done[segment] += num_bytes
+            progress = {
+                "url": self.url,
+                "ranges": self.ranges,
+                "done": self.done,
+            }
+            tmp_path = self.progress_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(progress))
+            tmp_path.replace(self.progress_path)
+
+            # Extend the hash over whatever is now complete from the start.
+            prefix = self.complete_prefix()
+            if prefix > self.hashed:
+                with open(self.part_path, "rb") as f:
+                    f.seek(self.hashed)
+                    self.digest.update(f.read(prefix - self.hashed))
+                self.hashed = prefix
+
+    def restart(self):
+        """Start over, for servers that ignore range requests."""
+        with self.lock:
+            self.done = [0] * len(self.done)
+            self.hashed = 0
+            self.digest = hashlib.sha256()
+
+    def fetch_segment(self, client, segment: int, progress, max_retries: int):
+        start, end = self.ranges[segment]
+        for attempt in range(max_retries + 1):
+            offset = start + self.done[segment]
+            if offset >= end:
+                return
+            try:
+                headers = {"Range": f"bytes={offset}-{end - 1}"}
+                with client.stream(
+                    "GET", self.url, headers=headers
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206 and offset > 0:
+                        self.restart()
+                        offset = 0
+                    with open(self.part_path, "r+b") as f:
+                        f.seek(offset)
+                        for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            chunk = chunk[: end - offset]
+                            f.write(chunk)
+                            f.flush()
+                            offset += len(chunk)
+                            self.record(segment, len(chunk))
+                            progress.update(len(chunk))
+                            if offset >= end:
+                                break
+                if offset >= end:
+                    return
+            except Exception as exc:
+                if attempt == max_retries:
+                    raise
+                print(
+                    f"segment {segment} of {self.url} failed, retrying: {exc}"
+                )
+            time.sleep(min(2**attempt, 30) * 0.1)
+        raise IOError(f"segment {segment} of {self.url} is incomplete")
+
+
+def download_file(
+    url: str,
+    output_path: pathlib.Path,
+    sha256: Optional[str] = None,
+    segments: int = 8,
+    max_retries: int = 5,
+):
     import httpx
     from tqdm import tqdm
 
-    with open(output_path, "wb") as download_file:
-        with httpx.stream("GET", url, follow_redirects=True) as response:
-            total = int(response.headers["Content-Length"])
-            with tqdm(
-                total=total, unit_scale=True, unit_divisor=1024, unit="B"
-            ) as progress:
-                num_bytes_downloaded = response.num_bytes_downloaded
-                for chunk in response.iter_bytes():
-                    download_file.write(chunk)
-                    progress.update(
-                        response.num_bytes_downloaded - num_bytes_downloaded
-                    )
-                    num_bytes_downloaded = response.num_bytes_downloaded
+    with httpx.Client(follow_redirects=True, timeout=60) as client:
+        head = client.head(url)
+        head.raise_for_status()
+        sha256 = sha256 or expected_sha256(head)
+        if output_path.exists():
+            if sha256 is None or file_sha256(output_path).hexdigest() == sha256:
+                print(f"{output_path.name} is already downloaded")
+                return
+
+        size = int(head.headers["Content-Length"])
+        if head.headers.get("Accept-Ranges") != "bytes":
+            segments = 1
+        segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+
+        part_path = output_path.with_name(output_path.name + ".part")
+        download = SegmentedDownload(url, part_path, size, segments)
+        with tqdm(
+            total=size,
+            initial=sum(download.done),
+            unit_scale=True,
+            unit_divisor=1024,
+            unit="B",
+        ) as progress, ThreadPoolExecutor(segments) as pool:
+            futures = [
+                pool.submit(
+                    download.fetch_segment, client, i, progress, max_retries
+                )
+                for i in range(segments)
+            ]
+            for future in futures:
+                future.result()
+
+    digest = download.digest.hexdigest()
+    download.progress_path.unlink()
+    if sha256 is not None and digest != sha256:
+        part_path.unlink()
+        raise ValueError(f"sha256 mismatch for {url}: {digest} != {sha256}")
+    part_path.replace(output_path)
+
+
+def download_files(
+    downloads: list[tuple[str, pathlib.Path]], max_files: int = 4
+) -> None:
+    with ThreadPoolExecutor(max_files) as pool:
+        for _ in pool.map(lambda args: download_file(*args), downloads):
+            pass
+
+
+MODELS_DIR = pathlib.Path("/root/models")
+BACKBONE_PATH = MODELS_DIR / "sd15_backbone.pth"
+CONTROL_PREFIX = "control_model."
+
+
+def split_checkpoint(checkpoint_path: pathlib.Path) -> None:
+    """
+    Saves the control network weights of a ControlNet checkpoint on their own,
+    in half precision, and the StableDiffusion backbone the first time we see it.
+    """
+    import torch
+
+    state_dict = torch.load(checkpoint_path, map_location="cpu")
+    state_dict = state_dict.get("state_dict", state_dict)
+    control = {
+        key[len(CONTROL_PREFIX) :]: value.half()
+        for key, value in state_dict.items()
+        if key.startswith(CONTROL_PREFIX)
+    }
+    torch.save(control, MODELS_DIR / f"{checkpoint_path.stem}.control.pth")
+    if not BACKBONE_PATH.exists():
+        backbone = {
+            key: value
+            for key, value in state_dict.items()
+            if not key.startswith(CONTROL_PREFIX)
+        }
+        torch.save(backbone, BACKBONE_PATH)
 
 
 def download_demo_files() -> None:
@@ -180,19 +401,29 @@ def download_demo_files() -> None:
 
     The ControlNet repo also instructs: 'Make sure that... detectors are put in "ControlNet/annotator/ckpts".'
     'ControlNet' is just the repo root, so we place in /root/annotator/ckpts.
+
+    Each full checkpoint is split into backbone and control network as soon as it
+    is downloaded, and then deleted, so the image only holds one backbone. The
+    detectors are small, so we download them all at once.
     """
-    demo = demos_map[os.environ["DEMO_NAME"]]
-    models_dir = pathlib.Path("/root/models")
-    for url in demo.model_files:
-        filepath = pathlib.Path(url).name
-        download_file(url=url, output_path=models_dir / filepath)
-        print(f"download complete for {filepath}")
+    model_urls = {url for demo in demos for url in demo.model_files}
+    for url in sorted(model_urls):
+        filepath = MODELS_DIR / pathlib.Path(url).name
+        if (MODELS_DIR / f"{filepath.stem}.control.pth").exists():
+            continue
+        download_file(url=url, output_path=filepath)
+        split_checkpoint(filepath)
+        filepath.unlink()
+        print(f"download complete for {filepath.name}")
 
     detectors_dir = pathlib.Path("/root/annotator/ckpts")
-    for url in demo.detector_files:
-        filepath = pathlib.Path(url).name
-        download_file(url=url, output_path=detectors_dir / filepath)
-        print(f"download complete for {filepath}")
+    detector_urls = {url for demo in demos for url in demo.detector_files}
+    download_files(
+        [
+            (url, detectors_dir / pathlib.Path(url).name)
+            for url in sorted(detector_urls)
+        ]
+    )
     print("🎉 finished baking demo file(s) into image.")
 
 
@@ -236,23 +467,484 @@ image = (
         "cd /root && git checkout main",
     )
     .apt_install("ffmpeg", "libsm6", "libxext6")
-    .run_function(
-        download_demo_files, secret=Secret.from_dict({"DEMO_NAME": DEMO_NAME})
-    )
+    .run_function(download_demo_files)
 )
 stub = Stub(name="example-controlnet", image=image)
 
 web_app = FastAPI()
 
+# ## Sharing one GPU between the demos
+#
+# ### Loading detectors lazily
+#
+# Each demo module creates its 'detector', the model that turns an input image into a
+# control image, when it is imported. Loading every detector up front would fill the GPU
+# with models nobody may use, so we hand the demos stand-ins that load the real detector
+# on first use. Loaded detectors live in a least-recently-used cache with a memory budget:
+# when loading one more detector takes the cache over budget, the detectors that were used
+# longest ago are dropped.
+
+DETECTOR_MEMORY_BUDGET = 4 * 1024**3  # bytes
+
+
+class DetectorCache:
+    def __init__(
+        self,
+        budget: int,
+        memory_used: Callable[[], int],
+        release: Callable[[object], None] = lambda detector: None,
+    ):
+        self.budget = budget
+        self.memory_used = memory_used
+        self.release = release
+        self.detectors: collections.OrderedDict = collections.OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def get(self, name: str, load: Callable[[], object]) -> object:
+        with self.lock:
+            if name in self.detectors:
+                self.detectors.move_to_end(name)
+                return self.detectors[name][0]
+
+            before = self.memory_used()
+            detector = load()
+            size = max(0, self.memory_used() - before)
+            self.detectors[name] = (detector, size)
+            self.used += size
+            while self.used > self.budget and len(self.detectors) > 1:
+                _, (evicted, evicted_size) = self.detectors.popitem(last=False)
+                self.used -= evicted_size
+                self.release(evicted)
+            return detector
+
+
+class LazyDetector:
+    def __init__(self, cache: DetectorCache, name: str, load: Callable):
+        self.cache = cache
+        self.name = name
+        self.load = load
+
+    def __call__(self, *args, **kwargs):
+        return self.cache.get(self.name, self.load)(*args, **kwargs)
+
+
+# ### Scheduling requests by demo
+#
+# All demos share one model, so before running a request for a demo, its control network
+# has to be loaded into the model. That takes a moment, so we don't want to switch back and
+# forth between demos with every request. Requests wait in a queue per demo, and a single
+# worker thread takes the queued requests of one demo as a batch, before switching to the
+# demo with the oldest waiting request. To keep one busy demo from starving the others, it
+# switches after `max_run` requests in a row when other demos are waiting.
+
+
+def run_sequentially(requests: list):
+    for fn, args, future in requests:
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+
+
+class DemoScheduler:
+    def __init__(
+        self,
+        switch: Callable[[str], None],
+        run_batch: Callable[[list], None] = run_sequentially,
+        max_run: int = 8,
+        max_batch: int = 4,
+    ):
+        self.switch = switch
+        self.run_batch = run_batch
+        self.max_run = max_run
+        self.max_batch = max_batch
+        self.pending: collections.OrderedDict = collections.OrderedDict()
+        self.current: Optional[str] = None
+        self.run_length = 0
+        self.condition = threading.Condition()
+        self.worker: Optional[threading.Thread] = None
+
+    def submit(self, demo_name: str, fn: Callable, *args) -> Future:
+        future: Future = Future()
+        with self.condition:
+            self.pending.setdefault(demo_name, collections.deque()).append(
+                (fn, args, future)
+            )
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.work, daemon=True)
+                self.worker.start()
+            self.condition.notify()
+        return future
+
+    def run(self, demo_name: str, fn: Callable, *args):
+        return self.submit(demo_name, fn, *args).result()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            others_waiting = any(name != self.current for name in self.pending)
+            if self.current in self.pending and (
+                self.run_length < self.max_run or not others_waiting
+            ):
+                demo_name = self.current
+                limit = (
+                    self.max_run - self.run_length if others_waiting else None
+                )
+            else:
+                demo_name = next(
+                    name for name in self.pending if name != self.current
+                )
+                limit = self.max_run
+            queue = self.pending[demo_name]
+            size = min(len(queue), self.max_batch, limit or self.max_batch)
+            batch = [queue.popleft() for _ in range(size)]
+            if not queue:
+                del self.pending[demo_name]
+            return demo_name, batch
+
+    def work(self):
+        while True:
+            demo_name, batch = self.next_batch()
+            try:
+                if demo_name != self.current:
+                    self.switch(demo_name)
+                    self.current, self.run_length = demo_name, 0
+            except Exception as exc:
+                for _, _, future in batch:
+                    future.set_exception(exc)
+                continue
+            self.run_length += len(batch)
+            self.run_batch(batch)
+
+
+# ### Batching the sampling
+#
+# The demos' event handlers are the `process` functions of the ControlNet repo, each of which
+# runs its detector, builds the conditioning for a prompt, and then calls
+# `DDIMSampler.sample` to denoise `num_samples` images. We can't just concatenate the
+# arguments of several requests and call `process` once, since every demo preprocesses its
+# inputs differently, and `process` takes a single image and prompt.
+#
+# What we can batch is the expensive part. The `SampleBatcher` runs the requests of a batch in
+# threads of their own, and stands in for `DDIMSampler.sample`. Each thread blocks once it
+# reaches sampling, and when all of them are waiting (or done), the calls with matching
+# settings are merged into a single call of the real `sample`, whose output is split up again.
+#
+# Two bits of state that the demos keep globally need care. They seed the global random
+# number generator with `seed_everything` just before sampling, so each call gets its
+# initial noise from a generator seeded with its own request's seed instead. And they set
+# `model.control_scales` on the shared model, which we make thread-local, so that requests
+# with different strengths don't overwrite each other's.
+
+MAX_BATCH_SAMPLES = 8  # images per merged sampling call
+
+
+@dataclass
+class SampleCall:
+    sampler: object
+    steps: int
+    batch_size: int
+    shape: tuple
+    conditioning: Optional[dict]
+    kwargs: dict
+    seed: Optional[int]
+    control_scales: list
+    done: threading.Event = field(default_factory=threading.Event)
+    result: object = None
+    error: Optional[Exception] = None
+
+    def key(self):
+        def layout(conditioning):
+            if conditioning is None:
+                return None
+            return tuple(
+                (name, None if value is None else len(value))
+                for name, value in sorted(conditioning.items())
+            )
+
+        options = {
+            name: value
+            for name, value in self.kwargs.items()
+            if name not in ("unconditional_conditioning", "x_T")
+        }
+        return (
+            id(self.sampler),
+            self.steps,
+            self.shape,
+            tuple(self.control_scales),
+            layout(self.conditioning),
+            layout(self.kwargs.get("unconditional_conditioning")),
+            repr(sorted(options.items())),
+        )
+
+    def noise(self):
+        import torch
+
+        if self.kwargs.get("x_T") is not None:
+            return self.kwargs["x_T"]
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator().manual_seed(self.seed)
+        noise = torch.randn((self.batch_size, *self.shape), generator=generator)
+        return noise.to(self.sampler.model.device)
+
+
+def merge_conditioning(conditionings: list) -> Optional[dict]:
+    import torch
+
+    if conditionings[0] is None:
+        return None
+    merged = {}
+    for name, value in conditionings[0].items():
+        if value is None:
+            merged[name] = None
+        else:
+            merged[name] = [
+                torch.cat(
+                    [conditioning[name][i] for conditioning in conditionings]
+                )
+                for i in range(len(value))
+            ]
+    return merged
+
+
+class SampleBatcher:
+    def __init__(self, sample: Callable, max_samples: int = MAX_BATCH_SAMPLES):
+        self.sample = sample
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting: list[SampleCall] = []
+        self.local = threading.local()
+
+    def seeded(self, seed_everything: Callable) -> Callable:
+        def record_seed(seed=None, *args, **kwargs):
+            self.local.seed = seed
+            return seed_everything(seed, *args, **kwargs)
+
+        return record_seed
+
+    def run_batch(self, requests: list):
+        if len(requests) == 1:
+            return run_sequentially(requests)
+        with self.lock:
+            self.running += len(requests)
+        threads = [
+            threading.Thread(target=self.run_request, args=request)
+            for request in requests
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_request(self, fn: Callable, args: tuple, future: Future):
+        self.local.batched, self.local.seed = True, None
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        finally:
+            self.local.batched = False
+            with self.lock:
+                self.running -= 1
+                ready = self.take_ready()
+            self.flush(ready)
+
+    def take_ready(self) -> list[SampleCall]:
+        # called with the lock held: once every running request is waiting, sample them
+        if self.waiting and len(self.waiting) == self.running:
+            ready, self.waiting = self.waiting, []
+            return ready
+        return []
+
+    def __call__(
+        self, sampler, S, batch_size, shape, conditioning=None, **kwargs
+    ):
+        if not getattr(self.local, "batched", False):
+            return self.sample(
+                sampler, S, batch_size, shape, conditioning, **kwargs
+            )
+        call = SampleCall(
+            sampler,
+            S,
+            batch_size,
+            tuple(shape),
+            conditioning,
+            kwargs,
+            seed=getattr(self.local, "seed", None),
+            control_scales=list(sampler.model.control_scales),
+        )
+        with self.lock:
+            self.waiting.append(call)
+            ready = self.take_ready()
+        self.flush(ready)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def flush(self, calls: list[SampleCall]):
+        groups = collections.defaultdict(list)
+        for call in calls:
+            groups[call.key()].append(call)
+        for group in groups.values():
+            chunk: list[SampleCall] = []
+            for call in group:
+                if chunk and (
+                    sum(c.batch_size for c in chunk) + call.batch_size
+                    > self.max_samples
+                ):
+                    self.run_merged(chunk)
+                    chunk = []
+                chunk.append(call)
+            self.run_merged(chunk)
+
+    def run_merged(self, calls: list[SampleCall]):
+        import torch
+
+        first = calls[0]
+        model = first.sampler.model
+        # this thread may have its own request waiting, with other scales.
+        own_scales, model.control_scales = (
+            model.control_scales,
+            first.control_scales,
+        )
+        try:
+            kwargs = dict(first.kwargs)
+            kwargs["x_T"] = torch.cat([call.noise() for call in calls])
+            if "unconditional_conditioning" in kwargs:
+                kwargs["unconditional_conditioning"] = merge_conditioning(
+                    [
+                        call.kwargs["unconditional_conditioning"]
+                        for call in calls
+                    ]
+                )
+            samples, intermediates = self.sample(
+                first.sampler,
+                first.steps,
+                sum(call.batch_size for call in calls),
+                first.shape,
+                merge_conditioning([call.conditioning for call in calls]),
+                **kwargs,
+            )
+        except Exception as exc:
+            for call in calls:
+                call.error = exc
+                call.done.set()
+            return
+        finally:
+            model.control_scales = own_scales
+        start = 0
+        for call in calls:
+            end = start + call.batch_size
+            call.result = (
+                samples[start:end],
+                {
+                    name: [step[start:end] for step in steps]
+                    for name, steps in intermediates.items()
+                },
+            )
+            call.done.set()
+            start = end
+
+
+def thread_local_control_scales(model):
+    local = threading.local()
+    default = list(model.control_scales)
+
+    def get(self):
+        return getattr(local, "scales", default)
+
+    def set(self, scales):
+        local.scales = scales
+
+    type(model).control_scales = property(get, set)
+
+
 # ## Serving the Gradio web UI
 #
 # Each ControlNet gradio demo module exposes a `block` Gradio interface running in queue-mode,
 # which is initialized in module scope on import and served on `0.0.0.0`. We want the block interface object,
 # but the queueing and launched webserver aren't compatible with Modal's serverless web endpoint interface,
 # so in the `import_gradio_app_blocks` function we patch out these behaviors.
+#
+# Each module also creates its own model and loads its full checkpoint into it on import. Before
+# importing the demos, we load the backbone into a single shared model and patch the ControlNet
+# code so that every demo gets that model, and their checkpoint loading does nothing. The demos'
+# detectors are replaced by lazy stand-ins, their event handlers are wrapped so that they
+# run through the scheduler, and their sampling goes through the `SampleBatcher`.
+
+DETECTORS = {
+    "annotator.canny": "CannyDetector",
+    "annotator.hed": "HEDdetector",
+    "annotator.midas": "MidasDetector",
+    "annotator.mlsd": "MLSDdetector",
+    "annotator.openpose": "OpenposeDetector",
+    "annotator.uniformer": "UniformerDetector",
+}
 
 
-def import_gradio_app_blocks(demo: DemoApp):
+def load_shared_model() -> DemoScheduler:
+    import gc
+
+    import pytorch_lightning
+    import torch
+    from cldm import ddim_hacked, model as cldm_model
+
+    model = cldm_model.create_model("./models/cldm_v15.yaml").cpu()
+    model.load_state_dict(torch.load(BACKBONE_PATH), strict=False)
+    model = model.cuda()
+    thread_local_control_scales(model)
+
+    batcher = SampleBatcher(ddim_hacked.DDIMSampler.sample)
+    ddim_hacked.DDIMSampler.sample = lambda sampler, *args, **kwargs: batcher(
+        sampler, *args, **kwargs
+    )
+    # the demos import `seed_everything` from here, so they get the seed-recording version.
+    pytorch_lightning.seed_everything = batcher.seeded(
+        pytorch_lightning.seed_everything
+    )
+
+    active_control = None
+
+    def switch(demo_name: str):
+        nonlocal active_control
+        control_name = demos_map[demo_name].control_name
+        if control_name != active_control:
+            weights = torch.load(
+                MODELS_DIR / f"{control_name}.control.pth", map_location="cuda"
+            )
+            model.control_model.load_state_dict(weights)
+            active_control = control_name
+
+    cldm_model.create_model = lambda *args, **kwargs: model
+    cldm_model.load_state_dict = lambda *args, **kwargs: {}
+    model.load_state_dict = lambda *args, **kwargs: None
+
+    def release(detector):
+        del detector
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    cache = DetectorCache(
+        DETECTOR_MEMORY_BUDGET, torch.cuda.memory_allocated, release
+    )
+    for module_name, class_name in DETECTORS.items():
+        module = importlib.import_module(module_name)
+        detector_class = getattr(module, class_name)
+        setattr(
+            module,
+            class_name,
+            lambda cls=detector_class: LazyDetector(cache, cls.__name__, cls),
+        )
+
+    return DemoScheduler(switch, run_batch=batcher.run_batch)
+
+
+def import_gradio_app_blocks(demo: DemoApp, scheduler: DemoScheduler):
     from gradio import blocks
 
     # The ControlNet repo demo scripts are written to be run as
@@ -270,6 +962,12 @@ def import_gradio_app_blocks(demo: DemoApp):
     blocks = mod.block
     # disable queueing mode, which is incompatible with our Modal web app setup.
     blocks.enable_queue = False
+    # our scheduler queues requests instead.
+    for block_fn in blocks.fns:
+        if block_fn.fn is not None:
+            block_fn.fn = lambda *args, fn=block_fn.fn: scheduler.run(
+                demo.name, fn, *args
+            )
     return blocks
 
 
@@ -277,29 +975,283 @@ def import_gradio_app_blocks(demo: DemoApp):
 # the web app function is limited to running just 1 warm container. This way, while playing
 # with the demos we can pay the cold-start cost once and have all web requests hit the warm
 # container. Spinning up extra containers to handle additional requests would not be efficient
-# given the cold-start time.
+# given the cold-start time. The container takes several requests at once, so that the
+# scheduler has requests to batch.
+#
+# Every demo is mounted at its own path, and the root path lists them all.
+
+
+MAX_CONCURRENT_REQUESTS = 16
 
 
 @stub.function(
     gpu="A10G",
     concurrency_limit=1,
     keep_warm=1,
+    allow_concurrent_inputs=MAX_CONCURRENT_REQUESTS,
 )
 @asgi_app()
 def run():
     from gradio.routes import mount_gradio_app
 
-    # mount for execution on Modal
-    return mount_gradio_app(
-        app=web_app,
-        blocks=import_gradio_app_blocks(demo=selected_demo),
-        path="/",
+    scheduler = load_shared_model()
+    for demo in demos:
+        # mount for execution on Modal
+        mount_gradio_app(
+            app=web_app,
+            blocks=import_gradio_app_blocks(demo=demo, scheduler=scheduler),
+            path=f"/{demo.name}",
+        )
+
+    @web_app.get("/", response_class=HTMLResponse)
+    def index():
+        links = "".join(
+            f'<li><a href="/{demo.name}/">{demo.name}</a></li>'
+            for demo in demos
+        )
+        return f"<h1>ControlNet demos</h1><ul>{links}</ul>"
+
+    return web_app
+
+
+# ## Testing without a GPU
+#
+# `modal run controlnet_gradio_demos.py --self-test` checks the detector cache, the scheduler
+# and the sample batching locally, with stand-ins for the detectors, the demos and the
+# sampler, and then runs the downloader against a local HTTP server.
+
+
+@stub.local_entrypoint()
+def main(self_test: bool = False, size_mb: int = 64):
+    if not self_test:
+        print(
+            "Serve the demos with `modal serve controlnet_gradio_demos.py`,"
+            " or pass --self-test to test them locally."
+        )
+        return
+    test_scheduling()
+    test_sample_batching.remote()
+    test_downloader(size_mb)
+
+
+def test_scheduling():
+    import time
+
+    memory = {"used": 0}
+    released = []
+
+    def fake_detector(name: str, size: int):
+        def load():
+            memory["used"] += size
+            return lambda image: f"{name}({image})"
+
+        return LazyDetector(cache, name, load)
+
+    def release(detector):
+        released.append(detector("x"))
+
+    cache = DetectorCache(100, lambda: memory["used"], release)
+    midas, hed, mlsd = (
+        fake_detector("midas", 60),
+        fake_detector("hed", 30),
+        fake_detector("mlsd", 30),
     )
+    assert midas("a") == "midas(a)" and hed("b") == "hed(b)"
+    assert midas("c") == "midas(c)"  # midas is now the most recently used
+    assert mlsd("d") == "mlsd(d)"  # over budget, so hed is released
+    assert released == ["hed(x)"] and list(cache.detectors) == ["midas", "mlsd"]
+
+    switches = []
+    order = []
+
+    def switch(demo_name):
+        switches.append(demo_name)
+        time.sleep(0.01)
+
+    def process(request):
+        order.append(request)
+        time.sleep(0.01)
+        return request
+
+    scheduler = DemoScheduler(switch, max_run=3)
+    blocker = threading.Event()
+    first = scheduler.submit("depth2image", blocker.wait)
+    requests = ["depth", "depth", "canny", "depth", "depth", "depth"]
+    futures = [
+        scheduler.submit(f"{name}2image", process, f"{name}{i}")
+        for i, name in enumerate(requests)
+    ]
+    blocker.set()
+    first.result()
+    assert [future.result() for future in futures] == [
+        f"{name}{i}" for i, name in enumerate(requests)
+    ]
+    # depth runs until it has had 3 requests in a row, then canny gets its turn.
+    assert order == ["depth0", "depth1", "canny2", "depth3", "depth4", "depth5"]
+    assert switches == ["depth2image", "canny2image", "depth2image"]
+    print("switches:", switches)
+    print("order:", order)
+
+
+# The sample batching test needs `torch`, so it runs in a CPU container on our image. The
+# stand-in demos seed, set their strength, and sample like the ControlNet ones do, and the
+# stand-in sampler adds each request's conditioning to its initial noise, so we can check
+# that every request gets back its own images.
+
+
+@stub.function(cpu=2)
+def test_sample_batching():
+    import torch
+
+    class FakeModel:
+        device = "cpu"
+        control_scales = [1.0] * 13
+
+    class FakeSampler:
+        model = FakeModel()
+
+    merged_calls = []
+
+    def sample(sampler, S, batch_size, shape, conditioning, x_T=None, **kwargs):
+        merged_calls.append((batch_size, sampler.model.control_scales[0]))
+        marker = conditioning["c_crossattn"][0].view(-1, 1, 1, 1)
+        return x_T + marker, {"x_inter": [x_T]}
+
+    batcher = SampleBatcher(sample, max_samples=8)
+    thread_local_control_scales(FakeSampler.model)
+    seed_everything = batcher.seeded(lambda seed: torch.manual_seed(seed))
+    sampler = FakeSampler()
+
+    def process(value, num_samples, seed, strength):
+        if value < 0:
+            raise ValueError("bad input")
+        seed_everything(seed)
+        FakeSampler.model.control_scales = [strength] * 13
+        time.sleep(0.01 * value)  # reach the sampler at different times
+        conditioning = {
+            "c_concat": [torch.zeros(num_samples, 1)],
+            "c_crossattn": [torch.full((num_samples, 1), float(value))],
+        }
+        samples, _ = batcher(
+            sampler, 20, num_samples, (1, 2, 2), conditioning, eta=0.0
+        )
+        assert FakeSampler.model.control_scales == [strength] * 13
+        return samples
+
+    requests = [
+        (1, 2, 11, 1.0),
+        (2, 3, 12, 1.0),
+        (3, 1, 13, 0.5),
+        (4, 4, 14, 1.0),
+    ]
+    futures = [Future() for _ in range(len(requests) + 1)]
+    batcher.run_batch(
+        [(process, args, future) for args, future in zip(requests, futures)]
+        + [(process, (-1, 1, 0, 1.0), futures[-1])]
+    )
+    for (value, num_samples, seed, _), future in zip(requests, futures):
+        noise = torch.randn(
+            (num_samples, 1, 2, 2),
+            generator=torch.Generator().manual_seed(seed),
+        )
+        assert torch.equal(future.result(), noise + value)
+    assert isinstance(futures[-1].exception(), ValueError)
+    # the first two share settings, the third has another strength, and the fourth
+    # doesn't fit in a batch of 8 images alongside the first two.
+    assert sorted(merged_calls) == [(1, 0.5), (4, 1.0), (5, 1.0)], merged_calls
+    print("merged sampling calls (images, strength):", merged_calls)
+
+
+# The downloader test serves a synthetic file, and cuts off every few responses halfway through.
+
+
+def test_downloader(size_mb: int = 64):
+    import http.server
+    import os
+    import tempfile
+
+    data = os.urandom(size_mb * 1024 * 1024)
+    sha256 = hashlib.sha256(data).hexdigest()
+    requests_seen = {"count": 0, "bytes": 0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_body_headers(self, start, end):
+            if "Range" in self.headers:
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end - 1}/{len(data)}"
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("X-Linked-Etag", f'"{sha256}"')
+            self.end_headers()
+
+        def byte_range(self):
+            match = re.fullmatch(
+                r"bytes=(\d+)-(\d+)", self.headers.get("Range", "")
+            )
+            if match is None:
+                return 0, len(data)
+            return int(match.group(1)), int(match.group(2)) + 1
+
+        def do_HEAD(self):
+            self.send_body_headers(0, len(data))
+
+        def do_GET(self):
+            start, end = self.byte_range()
+            self.send_body_headers(start, end)
+            requests_seen["count"] += 1
+            if requests_seen["count"] % 3 == 0:  # drop the connection halfway
+                end = start + (end - start) // 2
+            self.wfile.write(data[start:end])
+            requests_seen["bytes"] += end - start
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/synthetic.bin"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = pathlib.Path(tmp) / "synthetic.bin"
+
+        # With no retries, dropped connections stop the download partway...
+        try:
+            download_file(url, output_path, max_retries=0)
+        except Exception as exc:
+            print(f"download failed as expected: {exc!r}")
+        part_path = output_path.with_name(output_path.name + ".part")
+        assert part_path.exists() and not output_path.exists()
+
+        # ...and downloading again resumes from the `.part` file and finishes.
+        served_before = requests_seen["bytes"]
+        download_file(url, output_path)
+        assert requests_seen["bytes"] - served_before < len(data)
+        assert output_path.read_bytes() == data
+        assert not part_path.exists()
+
+        # A file that is already in place with the right hash is skipped.
+        before = requests_seen["count"]
+        download_files([(url, output_path)])
+        assert requests_seen["count"] == before
+
+        # A wrong hash is caught.
+        output_path.unlink()
+        try:
+            download_file(url, output_path, sha256="0" * 64)
+            raise AssertionError("expected a hash mismatch")
+        except ValueError as exc:
+            print(f"hash mismatch caught: {exc}")
+    server.shutdown()
+    print("downloader test passed")
 
 
 # ## Have fun!
 #
-# Serve your chosen demo app with `modal serve controlnet_gradio_demos.py`. If you don't have any images ready at hand,
+# Serve all the demo apps with `modal serve controlnet_gradio_demos.py`, and pick one from the list at the root URL. If you don't have any images ready at hand,
 # try one that's in the `06_gpu_and_ml/controlnet/demo_images/` folder.
 #
 # StableDiffusion was already impressive enough, but ControlNet's ability to so accurately and intuitively constrain
@@ -26,6 +26,7 @@
 # We can start from a base image and specify all of our dependencies.
 
 import os
+import threading
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -124,6 +125,13 @@ class TrainConfig(SharedConfig):
     max_train_steps: int = 600
     checkpointing_steps: int = 1000
 
+    # Training the text encoder as well as the UNet needs at least 16GB of GPU RAM.
+    train_text_encoder: bool = True
+    # Encode the instance images with the VAE once, ahead of training, instead of on
+    # every training step. Prompts are also encoded once, unless the text encoder is
+    # being trained.
+    cache_latents: bool = True
+
 
 @dataclass
 class AppConfig(SharedConfig):
@@ -138,22 +146,184 @@ class AppConfig(SharedConfig):
 # Part of the magic of Dreambooth is that we only need 4-10 images for finetuning.
 # So we can fetch just a few images, stored on consumer platforms like Imgur or Google Drive
 # -- no need for expensive data collection or data engineering.
+#
+# We download the images concurrently and store them in our volume, already resized
+# and center-cropped to the training resolution, so the training script never has to
+# decode and resize the originals. Each image is named after a hash of its content,
+# so the same image behind two URLs is only trained on once, and a manifest records
+# which URL held which image, so later runs only download URLs they haven't seen.
 
 IMG_PATH = Path("/img")
 
 
-def load_images(image_urls):
+def instance_data_dir(resolution: int) -> Path:
+    return MODEL_DIR / "instance-data" / f"{resolution}px"
+
+
+def prepare_instance_images(
+    image_urls, resolution: int, data_dir: Path, max_workers: int = 8
+):
+    """Returns the paths of the prepared, deduplicated images for `image_urls`."""
+    import hashlib
+    import io
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
     import PIL.Image
+    import PIL.ImageOps
     from smart_open import open
+    from torchvision import transforms
 
-    os.makedirs(IMG_PATH, exist_ok=True)
-    for ii, url in enumerate(image_urls):
+    # The same resizing and cropping as in the training script.
+    resize = transforms.Compose(
+        [
+            transforms.Resize(
+                resolution, interpolation=transforms.InterpolationMode.BILINEAR
+            ),
+            transforms.CenterCrop(resolution),
+        ]
+    )
+    images_dir = data_dir / "images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = data_dir / "manifest.json"
+    manifest = {}
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+
+    def fetch(url):
         with open(url, "rb") as f:
-            image = PIL.Image.open(f)
-            image.save(IMG_PATH / f"{ii}.png")
-    print("Images loaded.")
+            data = f.read()
+        name = f"{hashlib.sha256(data).hexdigest()[:16]}.png"
+        path = images_dir / name
+        if not path.exists():
+            image = PIL.Image.open(io.BytesIO(data))
+            image = PIL.ImageOps.exif_transpose(image).convert("RGB")
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            resize(image).save(tmp_path, format="PNG")
+            tmp_path.replace(path)
+        return url, name
+
+    new_urls = [url for url in dict.fromkeys(image_urls) if url not in manifest]
+    with ThreadPoolExecutor(max_workers) as pool:
+        manifest.update(pool.map(fetch, new_urls))
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+    names = sorted({manifest[url] for url in image_urls})
+    print(
+        f"Downloaded {len(new_urls)} new images,"
+        f" {len(names)} distinct instance images."
+    )
+    return [images_dir / name for name in names]
+
+
+# ### Caching latents
+#
+# The training script passes every batch of images through the VAE encoder on every
+# training step, but with so few images, it keeps encoding the same ones. So we encode
+# each image once, ahead of training, and save the mean and standard deviation of its
+# latent distribution in the volume, next to the images.
+#
+# During training, `CachedLatentEncoder` stands in for the VAE. It finds each image
+# of a batch in the cache by hashing its pixels, and samples from the cached
+# distribution, which is exactly what the real VAE would return.
+
 
-    return IMG_PATH
+def load_pixel_values(path: Path):
+    """Loads an image the way the training script does, normalized to [-1, 1]."""
+    import PIL.Image
+    from torchvision import transforms
+
+    to_tensor = transforms.Compose(
+        [transforms.ToTensor(), transforms.Normalize([0.5], [0.5])]
+    )
+    with PIL.Image.open(path) as image:
+        return to_tensor(image.convert("RGB"))
+
+
+def pixel_key(pixel_values) -> str:
+    import hashlib
+
+    import torch
+
+    # Converting back to 8-bit pixels makes the key robust to the float16 cast
+    # the training script applies before encoding.
+    pixels = ((pixel_values.float() + 1) * 127.5).round().clamp(0, 255)
+    pixels = pixels.to(torch.uint8).cpu().numpy()
+    return hashlib.sha256(pixels.tobytes()).hexdigest()
+
+
+def build_latent_cache(vae, image_paths, cache_path: Path) -> dict:
+    """Encodes the images that aren't in the cache at `cache_path` yet."""
+    import torch
+
+    cache = {"latents": {}}
+    if cache_path.exists():
+        cache = torch.load(cache_path)
+    cache["scaling_factor"] = vae.config.scaling_factor
+
+    num_encoded = 0
+    with torch.no_grad():
+        for path in image_paths:
+            pixel_values = load_pixel_values(path)
+            key = pixel_key(pixel_values)
+            if key in cache["latents"]:
+                continue
+            dist = vae.encode(
+                pixel_values[None].to(vae.device, vae.dtype)
+            ).latent_dist
+            cache["latents"][key] = (
+                dist.mean[0].float().cpu(),
+                dist.std[0].float().cpu(),
+            )
+            num_encoded += 1
+    torch.save(cache, cache_path)
+    print(f"Encoded {num_encoded} images, {len(cache['latents'])} in cache.")
+    return cache
+
+
+class LatentDistribution:
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def sample(self, generator=None):
+        import torch
+
+        noise = torch.randn(
+            self.mean.shape,
+            generator=generator,
+            device=self.mean.device,
+            dtype=self.mean.dtype,
+        )
+        return self.mean + self.std * noise
+
+
+class CachedLatentEncoder:
+    """The parts of the VAE's interface that the training script uses."""
+
+    def __init__(self, cache: dict):
+        from types import SimpleNamespace
+
+        self.latents = cache["latents"]
+        self.config = SimpleNamespace(scaling_factor=cache["scaling_factor"])
+
+    def requires_grad_(self, requires_grad: bool = True):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def encode(self, pixel_values):
+        from types import SimpleNamespace
+
+        import torch
+
+        moments = [self.latents[pixel_key(image)] for image in pixel_values]
+        mean, std = (
+            torch.stack(tensors).to(pixel_values.device, pixel_values.dtype)
+            for tensors in zip(*moments)
+        )
+        return SimpleNamespace(latent_dist=LatentDistribution(mean, std))
 
 
 # ## Finetuning a text-to-image model
@@ -185,6 +355,10 @@ def load_images(image_urls):
 # It should take about ten minutes.
 #
 # Tip: if the results you're seeing don't match the prompt too well, and instead produce an image of your subject again, the model has likely overfit. In this case, repeat training with a lower # of max_train_steps. On the other hand, if the results don't look like your subject, you might need to increase # of max_train_steps.
+#
+# We run the training script in the same process, rather than with `accelerate launch`,
+# so that we can hand it our cached latents in place of the VAE. With a single GPU,
+# `accelerate launch` would only have started one process running the script anyway.
 
 
 @stub.function(
@@ -199,21 +373,26 @@ def load_images(image_urls):
     secrets=[Secret.from_name("huggingface")],
 )
 def train(instance_example_urls):
-    import subprocess
+    import shutil
+    import sys
+    from types import SimpleNamespace
 
     import huggingface_hub
-    from accelerate.utils import write_basic_config
     from transformers import CLIPTokenizer
 
     # set up TrainConfig
     config = TrainConfig()
 
     # set up runner-local image and shared model weight directories
-    img_path = load_images(instance_example_urls)
+    data_dir = instance_data_dir(config.resolution)
+    image_paths = prepare_instance_images(
+        instance_example_urls, config.resolution, data_dir
+    )
+    os.makedirs(IMG_PATH, exist_ok=True)
+    for path in image_paths:
+        shutil.copy(path, IMG_PATH / path.name)
     os.makedirs(MODEL_DIR, exist_ok=True)
-
-    # set up hugging face accelerate library for fast training
-    write_basic_config(mixed_precision="fp16")
+    stub.volume.commit()
 
     # authenticate to hugging face so we can download the model weights
     hf_key = os.environ["HUGGINGFACE_TOKEN"]
@@ -226,53 +405,130 @@ def train(instance_example_urls):
         license_error_msg = f"Unable to load tokenizer. Access to this model requires acceptance of the license on Hugging Face here: https://huggingface.co/{config.model_name}."
         raise Exception(license_error_msg) from e
 
+    # encode the instance images that aren't in the latent cache yet
+    if config.cache_latents:
+        from diffusers import AutoencoderKL
+
+        vae = AutoencoderKL.from_pretrained(config.model_name, subfolder="vae")
+        cache_path = (
+            data_dir / f"latents--{config.model_name.replace('/', '--')}.pt"
+        )
+        latent_cache = build_latent_cache(
+            vae.to("cuda"), image_paths, cache_path
+        )
+        del vae
+        stub.volume.commit()
+
     # define the training prompt
     instance_phrase = f"{config.instance_name} {config.class_name}"
     prompt = f"{config.prefix} {instance_phrase} {config.postfix}".strip()
 
-    def _exec_subprocess(cmd: list[str]):
-        """Executes subprocess and prints log to terminal while subprocess is running."""
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+    # run training -- see the diffusers dreambooth example for details
+    print("launching dreambooth training script")
+    sys.path.insert(0, "/root/examples/dreambooth")
+    import train_dreambooth
+
+    script_args = [
+        f"--pretrained_model_name_or_path={config.model_name}",
+        f"--instance_data_dir={IMG_PATH}",
+        f"--output_dir={MODEL_DIR}",
+        f"--instance_prompt={prompt}",
+        f"--resolution={config.resolution}",
+        f"--train_batch_size={config.train_batch_size}",
+        f"--gradient_accumulation_steps={config.gradient_accumulation_steps}",
+        f"--learning_rate={config.learning_rate}",
+        f"--lr_scheduler={config.lr_scheduler}",
+        f"--lr_warmup_steps={config.lr_warmup_steps}",
+        f"--max_train_steps={config.max_train_steps}",
+        f"--checkpointing_steps={config.checkpointing_steps}",
+        "--mixed_precision=fp16",
+    ]
+    if config.train_text_encoder:
+        script_args.append("--train_text_encoder")
+    elif config.cache_latents:
+        script_args.append("--pre_compute_text_embeddings")
+    if config.cache_latents:
+        # The script loads its VAE with `AutoencoderKL.from_pretrained`.
+        encoder = CachedLatentEncoder(latent_cache)
+        train_dreambooth.AutoencoderKL = SimpleNamespace(
+            from_pretrained=lambda *args, **kwargs: encoder
         )
-        with process.stdout as pipe:
-            for line in iter(pipe.readline, b""):
-                line_str = line.decode()
-                print(f"{line_str}", end="")
-
-        if exitcode := process.wait() != 0:
-            raise subprocess.CalledProcessError(exitcode, "\n".join(cmd))
+    train_dreambooth.main(train_dreambooth.parse_args(script_args))
 
-    # run training -- see huggingface accelerate docs for details
-    print("launching dreambooth training script")
-    _exec_subprocess(
-        [
-            "accelerate",
-            "launch",
-            "examples/dreambooth/train_dreambooth.py",
-            "--train_text_encoder",  # needs at least 16GB of GPU RAM.
-            f"--pretrained_model_name_or_path={config.model_name}",
-            f"--instance_data_dir={img_path}",
-            f"--output_dir={MODEL_DIR}",
-            f"--instance_prompt='{prompt}'",
-            f"--resolution={config.resolution}",
-            f"--train_batch_size={config.train_batch_size}",
-            f"--gradient_accumulation_steps={config.gradient_accumulation_steps}",
-            f"--learning_rate={config.learning_rate}",
-            f"--lr_scheduler={config.lr_scheduler}",
-            f"--lr_warmup_steps={config.lr_warmup_steps}",
-            f"--max_train_steps={config.max_train_steps}",
-            f"--checkpointing_steps={config.checkpointing_steps}",
-        ]
-    )
     # The trained model artefacts have been output to the volume mounted at `MODEL_DIR`.
     # To persist these artefacts for use in future inference function calls, we 'commit' the changes
     # to the volume.
     stub.volume.commit()
 
 
+# ### Testing the data preparation on CPU
+#
+# `modal run dreambooth_app.py::stub.test_instance_data` checks the preparation and
+# caching steps on a CPU, with a few generated images and a tiny, randomly initialised
+# VAE: duplicate images are dropped, a second run downloads nothing, and
+# `CachedLatentEncoder` returns the latents the VAE would have for a training batch.
+
+
+@stub.function(image=image)
+def test_instance_data(resolution: int = 64):
+    import shutil
+    import tempfile
+
+    import numpy as np
+    import PIL.Image
+    import torch
+    from diffusers import AutoencoderKL
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    rng = np.random.default_rng(0)
+    urls = []
+    for i, (width, height) in enumerate([(96, 80), (70, 120), (64, 64)]):
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        url = str(tmp_dir / f"source-{i}.jpg")
+        PIL.Image.fromarray(pixels).save(url)
+        urls.append(url)
+    shutil.copy(urls[0], tmp_dir / "duplicate.jpg")
+    urls.append(str(tmp_dir / "duplicate.jpg"))
+
+    data_dir = tmp_dir / "instance-data"
+    image_paths = prepare_instance_images(urls, resolution, data_dir)
+    assert len(image_paths) == 3
+    for path in image_paths:
+        assert PIL.Image.open(path).size == (resolution, resolution)
+    for url in urls:
+        Path(url).unlink()  # so a second download would fail
+    assert prepare_instance_images(urls, resolution, data_dir) == image_paths
+
+    vae = AutoencoderKL(
+        block_out_channels=(32,),
+        down_block_types=("DownEncoderBlock2D",),
+        up_block_types=("UpDecoderBlock2D",),
+        norm_num_groups=8,
+    ).eval()
+    cache_path = data_dir / "latents.pt"
+    cache = build_latent_cache(vae, image_paths, cache_path)
+    assert (
+        build_latent_cache(vae, image_paths, cache_path).keys() == cache.keys()
+    )
+
+    # a shuffled training batch, cast to float16 like the training script does
+    batch = torch.stack([load_pixel_values(p) for p in image_paths[::-1]])
+    with torch.no_grad():
+        expected = vae.encode(batch).latent_dist
+    encoder = CachedLatentEncoder(torch.load(cache_path))
+    cached = encoder.encode(batch.half()).latent_dist
+    torch.testing.assert_close(
+        cached.mean.float(), expected.mean, rtol=1e-3, atol=1e-3
+    )
+    torch.testing.assert_close(
+        cached.std.float(), expected.std, rtol=1e-3, atol=1e-3
+    )
+    assert cached.sample().shape == expected.sample().shape
+    assert encoder.config.scaling_factor == vae.config.scaling_factor
+    shutil.rmtree(tmp_dir)
+    print("Instance data preparation and latent cache OK.")
+
+
 # ## The inference function.
 #
 # To generate images from prompts using our fine-tuned model, we define a function called `inference`.
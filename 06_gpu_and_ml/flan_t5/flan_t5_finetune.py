@@ -19,7 +19,9 @@
 # using the `pip_install` function.
 #
 
+import threading
 from pathlib import Path
+from typing import Optional
 
 import modal
 from modal import Image, Stub, Volume, method, wsgi_app
@@ -64,89 +66,122 @@ def track_restarts(restart_tracker: modal.Dict):
         restart_tracker["count"] = preemption_count
 
 
-# ## Finetuning Flan-T5 on XSum dataset
+# ## Preparing the dataset
 #
 # Each row in the dataset has a `document` (input news article) and `summary` column.
+#
+# Tokenizing the dataset takes minutes, and we'd have to do it again every time the job
+# restarts after a preemption. So we tokenize it once and save the result to the volume as
+# Arrow files, in a directory named after everything that affects the tokens: the tokenizer,
+# the maximum lengths, and the share of the dataset we use. On a restart, `load_from_disk`
+# memory-maps the saved files, which takes a moment, whatever the size of the dataset.
+#
+# We don't pad the examples here. The data collator pads each batch to its longest example
+# instead, which is usually much shorter than the maximum length, and it pads the labels with
+# `-100`, a label id that the loss function ignores.
+
+MAX_SOURCE_LENGTH = 512
+MAX_TARGET_LENGTH = 128
+LABEL_PAD_TOKEN_ID = -100
+
+
+def tokenized_dataset_path(size_percentage: int) -> Path:
+    name = "_".join(
+        [
+            "xsum",
+            BASE_MODEL.replace("/", "--"),
+            str(MAX_SOURCE_LENGTH),
+            str(MAX_TARGET_LENGTH),
+            f"{size_percentage}pct" if size_percentage else "full",
+        ]
+    )
+    return VOL_MOUNT_PATH / "datasets" / name
 
 
-@stub.function(
-    gpu="A10g",
-    timeout=7200,
-    volumes={VOL_MOUNT_PATH: output_vol},
-)
-def finetune(num_train_epochs: int = 1, size_percentage: int = 10):
-    from datasets import load_dataset
-    from transformers import (
-        AutoModelForSeq2SeqLM,
-        AutoTokenizer,
-        DataCollatorForSeq2Seq,
-        Seq2SeqTrainer,
-        Seq2SeqTrainingArguments,
-        TrainerCallback,
-    )
+def load_tokenized_xsum(tokenizer, size_percentage: int):
+    import shutil
 
-    track_restarts(stub.restart_tracker_dict)
+    from datasets import DatasetDict, load_dataset
+
+    path = tokenized_dataset_path(size_percentage)
+    if path.exists():
+        print(f"Loading tokenized dataset from {path}")
+        return DatasetDict.load_from_disk(str(path))
 
     # Use size percentage to retrieve subset of the dataset to iterate faster
     if size_percentage:
-        xsum_train = load_dataset("xsum", split=f"train[:{size_percentage}%]")
-        xsum_test = load_dataset("xsum", split=f"test[:{size_percentage}%]")
+        xsum = DatasetDict(
+            train=load_dataset("xsum", split=f"train[:{size_percentage}%]"),
+            test=load_dataset("xsum", split=f"test[:{size_percentage}%]"),
+        )
 
     # Load the whole dataset
     else:
         xsum = load_dataset("xsum")
-        xsum_train = xsum["train"]
-        xsum_test = xsum["test"]
-
-    # Load the tokenizer and model
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL)
-    model = AutoModelForSeq2SeqLM.from_pretrained(BASE_MODEL)
-
-    # Replace all padding tokens with a large negative number so that the loss function ignores them in
-    # its calculation
-    padding_token_id = -100
-
-    batch_size = 8
+        xsum = DatasetDict(train=xsum["train"], test=xsum["test"])
 
     def preprocess(batch):
         # prepend summarize: prefix to document to convert the example to a summarization instruction
         inputs = ["summarize: " + doc for doc in batch["document"]]
 
         model_inputs = tokenizer(
-            inputs, max_length=512, truncation=True, padding="max_length"
+            inputs, max_length=MAX_SOURCE_LENGTH, truncation=True
         )
-
         labels = tokenizer(
             text_target=batch["summary"],
-            max_length=128,
+            max_length=MAX_TARGET_LENGTH,
             truncation=True,
-            padding="max_length",
         )
-
-        labels["input_ids"] = [
-            [
-                l if l != tokenizer.pad_token_id else padding_token_id
-                for l in label
-            ]
-            for label in labels["input_ids"]
-        ]
-
         model_inputs["labels"] = labels["input_ids"]
         return model_inputs
 
-    tokenized_xsum_train = xsum_train.map(
+    tokenized = xsum.map(
         preprocess, batched=True, remove_columns=["document", "summary", "id"]
     )
 
-    tokenized_xsum_test = xsum_test.map(
-        preprocess, batched=True, remove_columns=["document", "summary", "id"]
+    # Write to a temporary directory first, so that a preemption halfway through
+    # doesn't leave an incomplete dataset behind.
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tokenized.save_to_disk(str(tmp_path))
+    tmp_path.rename(path)
+    stub.volume.commit()
+    return DatasetDict.load_from_disk(str(path))
+
+
+# ## Finetuning Flan-T5 on XSum dataset
+
+
+@stub.function(
+    gpu="A10g",
+    timeout=7200,
+    volumes={VOL_MOUNT_PATH: output_vol},
+)
+def finetune(num_train_epochs: int = 1, size_percentage: int = 10):
+    from transformers import (
+        AutoModelForSeq2SeqLM,
+        AutoTokenizer,
+        DataCollatorForSeq2Seq,
+        Seq2SeqTrainer,
+        Seq2SeqTrainingArguments,
+        TrainerCallback,
     )
 
+    track_restarts(stub.restart_tracker_dict)
+
+    # Load the tokenizer and model
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL)
+    model = AutoModelForSeq2SeqLM.from_pretrained(BASE_MODEL)
+
+    tokenized_xsum = load_tokenized_xsum(tokenizer, size_percentage)
+
+    batch_size = 8
+
     data_collator = DataCollatorForSeq2Seq(
         tokenizer,
         model=model,
-        label_pad_token_id=padding_token_id,
-        pad_to_multiple_of=batch_size,
+        label_pad_token_id=LABEL_PAD_TOKEN_ID,
+        pad_to_multiple_of=8,
     )
 
     class CheckpointCallback(TrainerCallback):
@@ -183,8 +218,8 @@ def finetune(num_train_epochs: int = 1, size_percentage: int = 10):
         args=training_args,
         callbacks=[CheckpointCallback(stub.volume)],
         data_collator=data_collator,
-        train_dataset=tokenized_xsum_train,
-        eval_dataset=tokenized_xsum_test,
+        train_dataset=tokenized_xsum["train"],
+        eval_dataset=tokenized_xsum["test"],
     )
 
     try:
@@ -227,32 +262,224 @@ def monitor():
 
 # ## Model Inference
 #
+# The summarizer serves the finetuned model that `finetune` saves to the volume, falling
+# back to the base model until there is one.
+#
+# Training keeps saving checkpoints while the summarizer is up, so a background thread
+# checks the volume for a newer checkpoint every minute. When it finds one, it loads it
+# next to the current model, and then swaps it in. Requests that are already running keep
+# the model they started with, so none of them fail or wait during the swap.
+#
+# `generate_batch` summarizes many inputs per call. It sorts them by length, so that each
+# padded batch holds inputs of similar lengths and little compute goes to padding, and
+# returns the summaries in the original order.
+
+CHECKPOINT_POLL_SECONDS = 60
+
+
+def latest_checkpoint(model_dir: Path) -> Optional[Path]:
+    """The most recently saved model in the output directory, if any."""
+    candidates = [model_dir, *model_dir.glob("checkpoint-*")]
+    saved = [path for path in candidates if (path / "config.json").exists()]
+    if not saved:
+        return None
+    return max(saved, key=saved_at)
+
+
+def saved_at(checkpoint: Path) -> float:
+    return (checkpoint / "config.json").stat().st_mtime
 
 
 @stub.cls(volumes={VOL_MOUNT_PATH: output_vol})
 class Summarizer:
+    model_dir = VOL_MOUNT_PATH / "model"
+    tokenizer_dir = VOL_MOUNT_PATH / "tokenizer"
+    poll_seconds = CHECKPOINT_POLL_SECONDS
+
     def __enter__(self):
-        from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, pipeline
+        from transformers import AutoTokenizer
 
-        # Load saved tokenizer and finetuned from training run
-        tokenizer = AutoTokenizer.from_pretrained(
-            BASE_MODEL, cache_dir=VOL_MOUNT_PATH / "tokenizer/"
-        )
-        model = AutoModelForSeq2SeqLM.from_pretrained(
-            BASE_MODEL, cache_dir=VOL_MOUNT_PATH / "model/"
+        # Load saved tokenizer and finetuned model from training run
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.tokenizer_dir if self.tokenizer_dir.exists() else BASE_MODEL
         )
+        self.version = self.latest_version()
+        self.model = self.load_model(self.version and self.version[0])
 
-        self.summarizer = pipeline(
-            "summarization", tokenizer=tokenizer, model=model
+        self.stop_watching = threading.Event()
+        self.watcher = threading.Thread(
+            target=self.watch_checkpoints, daemon=True
+        )
+        self.watcher.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_watching.set()
+
+    def load_model(self, checkpoint: Optional[Path]):
+        from transformers import AutoModelForSeq2SeqLM
+
+        print(f"Loading model from {checkpoint or BASE_MODEL}")
+        model = AutoModelForSeq2SeqLM.from_pretrained(checkpoint or BASE_MODEL)
+        return model.eval()
+
+    # A model is identified by its path and the time it was saved, since a new
+    # training run saves its final model to the same path as the previous one.
+    def latest_version(self) -> Optional[tuple[Path, float]]:
+        checkpoint = latest_checkpoint(self.model_dir)
+        return checkpoint and (checkpoint, saved_at(checkpoint))
+
+    def reload_volume(self):
+        stub.volume.reload()
+
+    def watch_checkpoints(self):
+        while not self.stop_watching.wait(self.poll_seconds):
+            try:
+                self.reload_volume()
+                version = self.latest_version()
+                if version is not None and version != self.version:
+                    self.model = self.load_model(version[0])
+                    self.version = version
+            except Exception as exc:
+                print(f"Couldn't check for a new checkpoint: {exc}")
+
+    def summarize(self, inputs: list[str], batch_size: int) -> list[str]:
+        import torch
+
+        # Keep using this model, even if a new one is swapped in.
+        model = self.model
+        params = dict(
+            (model.config.task_specific_params or {}).get("summarization", {})
         )
+        prefix = params.pop("prefix", "")
+        texts = [prefix + text for text in inputs]
+
+        lengths = [len(ids) for ids in self.tokenizer(texts)["input_ids"]]
+        order = sorted(range(len(texts)), key=lengths.__getitem__)
+        summaries: list[str] = [""] * len(texts)
+        for start in range(0, len(order), batch_size):
+            indices = order[start : start + batch_size]
+            batch = self.tokenizer(
+                [texts[i] for i in indices],
+                padding=True,
+                truncation=True,
+                return_tensors="pt",
+            )
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids=batch["input_ids"],
+                    attention_mask=batch["attention_mask"],
+                    **params,
+                )
+            decoded = self.tokenizer.batch_decode(
+                output_ids, skip_special_tokens=True
+            )
+            for i, summary in zip(indices, decoded):
+                summaries[i] = summary
+        return summaries
 
     @method()
     def generate(self, input: str) -> str:
-        return self.summarizer(input)[0]["summary_text"]
+        return self.summarize([input], batch_size=1)[0]
+
+    @method()
+    def generate_batch(
+        self, inputs: list[str], batch_size: int = 16
+    ) -> list[str]:
+        return self.summarize(inputs, batch_size)
+
+
+# ## Testing without a GPU
+#
+# `modal run flan_t5_finetune.py --self-test` runs the summarizer on a CPU, with tiny
+# randomly initialized models saved to a temporary directory in place of the volume. It
+# checks that batched summaries come back in the order of their inputs, and that the
+# watcher picks up a newly saved checkpoint and swaps it in while a call is still running
+# on the old model, which then finishes with the old model's results.
+
+
+@stub.function(cpu=2)
+def test_on_cpu():
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import torch
+    from transformers import T5Config, T5ForConditionalGeneration
+
+    def save_tiny_model(path: Path, seed: int):
+        torch.manual_seed(seed)
+        config = T5Config(
+            vocab_size=32128,
+            d_model=32,
+            d_kv=8,
+            d_ff=64,
+            num_layers=2,
+            num_heads=4,
+            decoder_start_token_id=0,  # T5 starts decoding from the pad token
+            task_specific_params={
+                "summarization": {"prefix": "summarize: ", "max_length": 12}
+            },
+        )
+        T5ForConditionalGeneration(config).save_pretrained(path)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        class LocalSummarizer(Summarizer.get_user_cls()):
+            model_dir = Path(tmp) / "model"
+            tokenizer_dir = Path(tmp) / "tokenizer"  # use the base tokenizer
+            poll_seconds = 0.1
+
+            def reload_volume(self):
+                pass
+
+        save_tiny_model(LocalSummarizer.model_dir, seed=0)
+        summarizer = LocalSummarizer()
+        summarizer.__enter__()
+        assert summarizer.version[0] == LocalSummarizer.model_dir
+
+        inputs = [
+            "A much longer article about the weather, " * (i % 3 + 1) + str(i)
+            for i in range(5)
+        ]
+        one_at_a_time = [summarizer.summarize([text], 1)[0] for text in inputs]
+        batched = summarizer.summarize(inputs, batch_size=2)
+        assert batched == one_at_a_time, (batched, one_at_a_time)
+
+        # Hold a call in the old model's `generate` while a new checkpoint arrives.
+        old_model, old_version = summarizer.model, summarizer.version
+        started, release = threading.Event(), threading.Event()
+        generate = old_model.generate
+
+        def held_generate(**kwargs):
+            started.set()
+            release.wait()
+            return generate(**kwargs)
+
+        old_model.generate = held_generate
+        with ThreadPoolExecutor() as pool:
+            in_flight = pool.submit(summarizer.summarize, inputs, 2)
+            started.wait()
+            checkpoint = LocalSummarizer.model_dir / "checkpoint-10"
+            save_tiny_model(checkpoint, seed=1)
+            deadline = time.monotonic() + 60
+            while summarizer.version == old_version:
+                assert time.monotonic() < deadline, "no new checkpoint found"
+                time.sleep(0.1)
+            assert summarizer.version[0] == checkpoint
+            assert summarizer.model is not old_model
+            release.set()
+            assert in_flight.result() == batched
+        assert len(summarizer.summarize(inputs, batch_size=2)) == len(inputs)
+        summarizer.__exit__(None, None, None)
+    print("Summarizer self-test passed")
 
 
 @stub.local_entrypoint()
-def main():
+def main(self_test: bool = False):
+    if self_test:
+        test_on_cpu.remote()
+        return
+
     input = """
     The 14-time major champion, playing in his first full PGA Tour event for almost 18 months,
     carded a level-par second round of 72, but missed the cut by four shots after his first-round 76.
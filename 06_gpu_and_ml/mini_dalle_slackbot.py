@@ -1,9 +1,12 @@
+import hashlib
 import io
 import os
+import re
+from pathlib import Path
 from typing import Optional
 
 from fastapi import Request
-from modal import Image, Secret, Stub, web_endpoint
+from modal import Image, Secret, Stub, Volume, method, web_endpoint
 
 CACHE_PATH = "/root/model_cache"
 
@@ -28,40 +31,115 @@ stub = Stub(
     image=Image.debian_slim().pip_install("min-dalle").run_function(load_model),
 )
 
+# Every command gets a new random image by default. To get the same image again,
+# end the command with a seed, like `/dalle a cat in a hat --seed 42`. Images
+# generated with a seed are kept in a persisted volume, under a hash of the
+# prompt, seed and grid size, so a repeated command is answered without running
+# the model. Random images are never reused, so they aren't cached. As in
+# min-dalle itself, a negative seed means a random one.
 
-@stub.function(
-    image=Image.debian_slim().pip_install("slack-sdk"),
-    secret=Secret.from_name("dalle-bot-slack-secret"),
-)
-def post_to_slack(prompt: str, channel_name: str, image_bytes: bytes):
-    import slack_sdk
+IMAGES_PATH = Path("/images")
+RANDOM_SEED = -1
+GRID_SIZE = 3
+
+stub.volume = Volume.persisted("example-dalle-bot-images")
+
+
+def image_path(prompt: str, seed: int, grid_size: int) -> Path:
+    key = hashlib.sha256(f"{prompt}\0{seed}\0{grid_size}".encode()).hexdigest()
+    return IMAGES_PATH / f"{key}.png"
+
+
+def parse_command(text: str) -> tuple[str, int]:
+    """Split a slash command's text into the prompt and an optional trailing seed."""
+    match = re.search(r"\s--seed[ =](\d+)\s*$", text)
+    if match is None:
+        return text.strip(), RANDOM_SEED
+    return text[: match.start()].strip(), int(match.group(1))
+
+
+# Uploads run asynchronously, on a Slack client that each container creates
+# once and reuses for all its uploads.
+
+slack_client = None
 
-    client = slack_sdk.WebClient(token=os.environ["SLACK_BOT_TOKEN"])
-    client.files_upload(
+
+async def post_to_slack(prompt: str, channel_name: str, image_bytes: bytes):
+    global slack_client
+    import aiohttp
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    if slack_client is None:
+        slack_client = AsyncWebClient(
+            token=os.environ["SLACK_BOT_TOKEN"], session=aiohttp.ClientSession()
+        )
+    await slack_client.files_upload(
         channels=channel_name, title=prompt, content=image_bytes
     )
 
 
-@stub.function(gpu="A10G")
-async def run_minidalle(prompt: str, channel_name: Optional[str]):
-    model = load_model(device="cuda")
+# The model is loaded once per container, and kept on the GPU between requests.
+# min-dalle generates a grid of images for one prompt per call, so each container
+# works through its requests one at a time, and Modal queues the rest for it.
 
-    image = model.generate_image(
-        text=prompt,
-        seed=-1,
-        grid_size=3,
-        is_seamless=False,
-        temperature=1,
-        top_k=256,
-        supercondition_factor=16,
-        is_verbose=False,
-    )
 
-    with io.BytesIO() as buf:
-        image.save(buf, format="PNG")
-        if channel_name:
-            post_to_slack.remote(prompt, channel_name, buf.getvalue())
-        return buf.getvalue()
+@stub.cls(gpu="A10G", volumes={IMAGES_PATH: stub.volume})
+class MinDalle:
+    def __enter__(self):
+        self.model = load_model(device="cuda")
+
+    @method()
+    def generate(self, prompt: str, seed: int, grid_size: int) -> bytes:
+        path = image_path(prompt, seed, grid_size)
+        if seed >= 0 and path.exists():
+            return path.read_bytes()
+
+        image = self.model.generate_image(
+            text=prompt,
+            seed=seed,
+            grid_size=grid_size,
+            is_seamless=False,
+            temperature=1,
+            top_k=256,
+            supercondition_factor=16,
+            is_verbose=False,
+        )
+
+        with io.BytesIO() as buf:
+            image.save(buf, format="PNG")
+            img_bytes = buf.getvalue()
+        if seed >= 0:
+            path.write_bytes(img_bytes)
+            stub.volume.commit()
+        return img_bytes
+
+
+@stub.function(
+    image=Image.debian_slim().pip_install("slack-sdk", "aiohttp"),
+    secret=Secret.from_name("dalle-bot-slack-secret"),
+    volumes={IMAGES_PATH: stub.volume},
+    allow_concurrent_inputs=20,
+)
+async def run_minidalle(
+    prompt: str, channel_name: Optional[str], seed: int = RANDOM_SEED
+):
+    path = image_path(prompt, seed, GRID_SIZE)
+    if seed >= 0 and not path.exists():
+        try:
+            # Pick up images that other containers have added since this one started.
+            await stub.volume.reload.aio()
+        except Exception as exc:  # e.g. if another input has a file open
+            print(f"Couldn't reload the image cache: {exc}")
+    if seed >= 0 and path.exists():
+        img_bytes = path.read_bytes()
+    else:
+        img_bytes = await MinDalle().generate.remote.aio(
+            prompt, seed, GRID_SIZE
+        )
+
+    if channel_name:
+        await post_to_slack(prompt, channel_name, img_bytes)
+    return img_bytes
 
 
 # python-multipart is needed for fastapi form parsing.
@@ -73,9 +151,9 @@ async def run_minidalle(prompt: str, channel_name: Optional[str]):
 )
 async def entrypoint(request: Request):
     body = await request.form()
-    prompt = body["text"]
+    prompt, seed = parse_command(body["text"])
     # Deferred call to function.
-    run_minidalle.spawn(prompt, body["channel_name"])
+    run_minidalle.spawn(prompt, body["channel_name"], seed)
     return f"Running text2im for {prompt}."
 
 
@@ -85,10 +163,12 @@ OUTPUT_DIR = "/tmp/render"
 
 
 @stub.local_entrypoint()
-def main(prompt: str = "martha stewart at burning man"):
+def main(
+    prompt: str = "martha stewart at burning man", seed: int = RANDOM_SEED
+):
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     output_path = os.path.join(OUTPUT_DIR, "output.png")
-    img_bytes = run_minidalle.remote(prompt, None)
+    img_bytes = run_minidalle.remote(prompt, None, seed)
     with open(output_path, "wb") as f:
         f.write(img_bytes)
     print(f"Done! Your DALL-E output image is at '{output_path}'")
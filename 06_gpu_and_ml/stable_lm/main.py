@@ -1,8 +1,9 @@
 import base64
 import os
+import re
 import time
 from pathlib import Path
-from typing import Any, Dict, Generator, List, Optional, Union
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
 
 import modal
 from pydantic import BaseModel
@@ -80,7 +81,10 @@ stub = modal.Stub(
 
 
 class CompletionRequest(BaseModel):
-    prompt: Annotated[str, "The prompt for text completion"]
+    prompt: Annotated[
+        Union[str, List[str]],
+        "The prompt for text completion, or a list of prompts to complete together",
+    ]
     model: Annotated[
         Literal["stabilityai/stablelm-tuned-alpha-7b"],
         "The model to use for text completion",
@@ -109,7 +113,7 @@ class CompletionRequest(BaseModel):
     ] = True
 
 
-@stub.cls(gpu="A10G")
+@stub.cls(gpu="A10G", allow_concurrent_inputs=8)
 class StabilityLM:
     def __init__(
         self,
@@ -131,22 +135,25 @@ class StabilityLM:
     def __enter__(self):
         """
         Container-lifeycle method for model setup.
+
+        The pipeline is shared by all inputs running in the container, so it doesn't own
+        a streamer: each call to `generate_completion` creates its own.
         """
         import torch
-        from transformers import AutoTokenizer, TextIteratorStreamer, pipeline
+        from transformers import AutoTokenizer, pipeline
 
         tokenizer = AutoTokenizer.from_pretrained(
             self.model_url, local_files_only=True
         )
+        # Batched prompts should end where generation starts.
+        tokenizer.padding_side = "left"
+        tokenizer.pad_token = tokenizer.eos_token
         self.stop_ids = tokenizer.convert_tokens_to_ids(self.stop_tokens)
-        self.streamer = TextIteratorStreamer(
-            tokenizer, skip_prompt=True, **self.decode_kwargs
-        )
+        self.stop_patterns: Dict[Tuple[str, ...], re.Pattern] = {}
         self.generator = pipeline(
             "text-generation",
             model=self.model_url,
             tokenizer=tokenizer,
-            streamer=self.streamer,
             torch_dtype=torch.float16,
             device_map="auto",
             model_kwargs={"local_files_only": True},
@@ -158,7 +165,7 @@ class StabilityLM:
     ) -> Dict[str, Any]:
         return dict(
             pad_token_id=self.generator.tokenizer.eos_token_id,
-            eos_token_id=list(
+            eos_token_id=sorted(
                 set(
                     self.generator.tokenizer.convert_tokens_to_ids(
                         self.generator.tokenizer.tokenize(
@@ -174,35 +181,155 @@ class StabilityLM:
             ),
         )
 
+    def stop_words_pattern(self, eos_token_ids: List[int]) -> re.Pattern:
+        """
+        Compiled pattern matching the stop words, built once per distinct set of stop words.
+        """
+        stop_words = tuple(
+            self.generator.tokenizer.convert_ids_to_tokens(eos_token_ids)
+        )
+        if stop_words not in self.stop_patterns:
+            self.stop_patterns[stop_words] = re.compile(
+                "|".join(map(re.escape, stop_words))
+            )
+        return self.stop_patterns[stop_words]
+
     def generate_completion(
         self, completion_request: CompletionRequest
     ) -> Generator[str, None, None]:
-        import re
         from threading import Thread
 
-        from transformers import GenerationConfig
+        from transformers import GenerationConfig, TextIteratorStreamer
 
         text = format_prompt(completion_request.prompt)
         gen_config = GenerationConfig(**self.get_config(completion_request))
-        stop_words = self.generator.tokenizer.convert_ids_to_tokens(
-            gen_config.eos_token_id
+        stop_words_pattern = self.stop_words_pattern(gen_config.eos_token_id)
+        streamer = TextIteratorStreamer(
+            self.generator.tokenizer, skip_prompt=True, **self.decode_kwargs
         )
-        stop_words_pattern = re.compile("|".join(map(re.escape, stop_words)))
         thread = Thread(
             target=self.generator.__call__,
-            kwargs=dict(text_inputs=text, generation_config=gen_config),
+            kwargs=dict(
+                text_inputs=text,
+                generation_config=gen_config,
+                streamer=streamer,
+            ),
         )
         thread.start()
-        for new_text in self.streamer:
+        for new_text in streamer:
             if new_text.strip():
                 new_text = stop_words_pattern.sub("", new_text)
                 yield new_text
         thread.join()
 
+    def _generate(self, inputs, gen_config, streamer: "TokenQueueStreamer"):
+        import torch
+
+        try:
+            with torch.inference_mode():
+                self.generator.model.generate(
+                    **inputs, generation_config=gen_config, streamer=streamer
+                )
+        except Exception as exc:
+            streamer.error = exc
+        finally:
+            streamer.end()
+
+    def stream_completions(
+        self, completion_requests: List[CompletionRequest]
+    ) -> Generator[Dict[str, Any], None, None]:
+        """
+        Run requests with the same generation settings through one padded `generate` call,
+        yielding `{"index": i, "text": new_text}` as each completion grows.
+
+        Requests are grouped by their config (ignoring `max_tokens`). Each group generates up
+        to its largest `max_tokens`, and every completion ends at its own limit or at its first
+        stop token. The last item yielded holds the `usage` token counts.
+        """
+        import json
+        from threading import Thread
+
+        from transformers import GenerationConfig
+
+        tokenizer = self.generator.tokenizer
+        groups: Dict[str, List[int]] = {}
+        for i, completion_request in enumerate(completion_requests):
+            config = self.get_config(completion_request)
+            del config["max_new_tokens"]
+            groups.setdefault(json.dumps(config, sort_keys=True), []).append(i)
+
+        prompt_tokens = completion_tokens = 0
+        for indices in groups.values():
+            batch = [completion_requests[i] for i in indices]
+            config = self.get_config(batch[0])
+            config["max_new_tokens"] = max(r.max_tokens for r in batch)
+            gen_config = GenerationConfig(**config)
+            stop_ids = set(gen_config.eos_token_id)
+
+            inputs = tokenizer(
+                [format_prompt(r.prompt) for r in batch],
+                return_tensors="pt",
+                padding=True,
+            ).to(self.generator.model.device)
+            prompt_tokens += int(inputs["attention_mask"].sum())
+
+            streamer = TokenQueueStreamer()
+            thread = Thread(
+                target=self._generate, args=(inputs, gen_config, streamer)
+            )
+            thread.start()
+            token_ids: List[List[int]] = [[] for _ in batch]
+            texts = ["" for _ in batch]
+            finished = [False for _ in batch]
+            for step_ids in streamer:
+                for j, (r, token_id) in enumerate(zip(batch, step_ids)):
+                    if finished[j] or token_id in stop_ids:
+                        finished[j] = True
+                        continue
+                    token_ids[j].append(token_id)
+                    finished[j] = len(token_ids[j]) >= r.max_tokens
+                    text = tokenizer.decode(token_ids[j])
+                    if text.endswith("\ufffd"):
+                        continue  # wait for the rest of a multi-byte character
+                    if len(text) > len(texts[j]):
+                        yield {
+                            "index": indices[j],
+                            "text": text[len(texts[j]) :],
+                        }
+                        texts[j] = text
+            thread.join()
+            completion_tokens += sum(len(ids) for ids in token_ids)
+
+        yield {
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        }
+
     @modal.method()
     def generate(self, completion_request: CompletionRequest) -> str:
         return "".join(self.generate_completion(completion_request))
 
+    @modal.method()
+    def generate_batch(
+        self, completion_requests: List[CompletionRequest]
+    ) -> Dict[str, Any]:
+        completions = [""] * len(completion_requests)
+        for event in self.stream_completions(completion_requests):
+            if "usage" in event:
+                return {"completions": completions, "usage": event["usage"]}
+            completions[event["index"]] += event["text"]
+        raise RuntimeError("generation ended without reporting usage")
+
+    @modal.method()
+    def generate_batch_stream(
+        self, completion_requests: List[CompletionRequest]
+    ) -> Generator:
+        for event in self.stream_completions(completion_requests):
+            yield event
+
     @modal.method()
     def generate_stream(
         self, completion_request: CompletionRequest
@@ -211,6 +338,36 @@ class StabilityLM:
             yield text
 
 
+class TokenQueueStreamer:
+    """
+    Streamer for batched `generate` calls, which hands over each step's new token ids (one
+    per sequence in the batch) through a queue. `generate` first passes in the prompt ids,
+    which are skipped.
+    """
+
+    def __init__(self):
+        import queue
+
+        self.queue: queue.Queue = queue.Queue()
+        self.prompt_skipped = False
+        self.error: Optional[Exception] = None
+
+    def put(self, value):
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        self.queue.put(value.tolist())
+
+    def end(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while (step_ids := self.queue.get()) is not None:
+            yield step_ids
+        if self.error is not None:
+            raise self.error
+
+
 def format_prompt(instruction: str) -> str:
     return f"<|USER|>{instruction}<|ASSISTANT|>"
 
@@ -226,12 +383,18 @@ if stub.is_inside():
         logprobs: Union[int, None] = None
         finish_reason: Union[str, None] = None
 
+    class Usage(msgspec.Struct):
+        prompt_tokens: int
+        completion_tokens: int
+        total_tokens: int
+
     class CompletionResponse(msgspec.Struct, kw_only=True):  # type: ignore
         id: Union[str, None] = None
         object: str = "text_completion"
         created: Union[int, None] = None
         model: str
         choices: List[Choice]
+        usage: Union[Usage, None] = None
 
         def __post_init__(self):
             if self.id is None:
@@ -249,7 +412,16 @@ async def completions(completion_request: CompletionRequest):
     response_id = str(uuid.uuid4())
     response_utc = int(time.time())
 
+    # A list of prompts is completed as one batch, with one choice per prompt.
+    prompts = completion_request.prompt
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    completion_requests = [
+        completion_request.copy(update={"prompt": prompt}) for prompt in prompts
+    ]
+
     if not completion_request.stream:
+        result = StabilityLM().generate_batch.remote(completion_requests)
         return Response(
             content=msgspec.json.encode(
                 CompletionResponse(
@@ -257,31 +429,38 @@ async def completions(completion_request: CompletionRequest):
                     created=response_utc,
                     model=completion_request.model,
                     choices=[
-                        Choice(
-                            index=0,
-                            text=StabilityLM().generate.remote(
-                                completion_request=completion_request
-                            ),
-                        )
+                        Choice(index=index, text=text)
+                        for index, text in enumerate(result["completions"])
                     ],
+                    usage=Usage(**result["usage"]),
                 )
             ),
             status_code=status.HTTP_200_OK,
             media_type="application/json",
         )
 
+    # Every streamed message shares the same envelope, so we encode it once and only
+    # encode the new choice for each message.
+    envelope = msgspec.json.encode(
+        CompletionResponse(
+            id=response_id,
+            created=response_utc,
+            model=completion_request.model,
+            choices=[],
+        )
+    )
+    head, tail = envelope.split(b'"choices":[]')
+
     def wrapped_stream():
-        for new_text in StabilityLM().generate_stream.remote(
-            completion_request=completion_request
+        for event in StabilityLM().generate_batch_stream.remote_gen(
+            completion_requests
         ):
-            yield msgspec.json.encode(
-                CompletionResponse(
-                    id=response_id,
-                    created=response_utc,
-                    model=completion_request.model,
-                    choices=[Choice(index=0, text=new_text)],
-                )
-            ) + b"\n\n"
+            if "usage" in event:
+                usage = msgspec.json.encode(Usage(**event["usage"]))
+                yield head + b'"choices":[],"usage":' + usage + b"}\n\n"
+            else:
+                choice = msgspec.json.encode(Choice(**event))
+                yield head + b'"choices":[' + choice + b"]" + tail + b"\n\n"
 
     return StreamingResponse(
         content=wrapped_stream(),
@@ -301,9 +480,8 @@ def main():
         CompletionRequest(prompt=q, max_tokens=128) for q in instructions
     ]
     print("Running example non-streaming completions:\n")
-    for q, a in zip(
-        instructions, list(StabilityLM().generate.map(instruction_requests))
-    ):
+    result = StabilityLM().generate_batch.remote(instruction_requests)
+    for q, a in zip(instructions, result["completions"]):
         print(f"{q_style}{q}{q_end}\n{a}\n\n")
 
     print("Running example streaming completion:\n")
@@ -12,9 +12,15 @@
 #
 # First we import the components we need from `modal`.
 
+import asyncio
+import collections
+import hashlib
+import json
+import time
 from pathlib import Path
+from typing import Optional
 
-from modal import Image, Mount, Secret, Stub, asgi_app, gpu, method
+from modal import Image, Mount, Secret, Stub, Volume, asgi_app, gpu, method
 
 # Next, we set which model to serve, taking care to specify the GPU configuration required
 # to fit the model into VRAM, and the quantization method (`bitsandbytes` or `gptq`) if desired.
@@ -87,6 +93,23 @@ image = (
 stub = Stub("example-tgi-" + MODEL_ID.split("/")[-1], image=image)
 
 
+# ## The prompt template
+#
+# Every question is wrapped in the same `[INST]` chat template before it's sent to the model, and generated with
+# the same parameters. TGI decodes greedily unless asked to sample, so these settings are deterministic.
+
+GENERATION_PARAMS = {"max_new_tokens": 1024}
+
+
+def format_prompt(question: str) -> str:
+    template = """<s>[INST] <<SYS>>
+{system}
+<</SYS>>
+
+{user} [/INST] """
+    return template.format(system="", user=question)
+
+
 # ## The model class
 #
 # The inference function is best represented with Modal's [class syntax](/docs/guide/lifecycle-functions).
@@ -102,15 +125,18 @@ stub = Stub("example-tgi-" + MODEL_ID.split("/")[-1], image=image)
 # Here, we also
 # - specify the secret so the `HUGGING_FACE_HUB_TOKEN` environment variable is set
 # - specify how many A100s we need per container
-# - specify that each container is allowed to handle up to 10 inputs (i.e. requests) simultaneously
+# - specify that each container is allowed to handle up to `MODEL_CONCURRENT_INPUTS` inputs (i.e. requests) simultaneously
 # - keep idle containers for 10 minutes before spinning down
 # - lift the timeout of each request.
 
 
+MODEL_CONCURRENT_INPUTS = 10
+
+
 @stub.cls(
     secret=Secret.from_name("huggingface"),
     gpu=GPU_CONFIG,
-    allow_concurrent_inputs=10,
+    allow_concurrent_inputs=MODEL_CONCURRENT_INPUTS,
     container_idle_timeout=60 * 10,
     timeout=60 * 60,
 )
@@ -126,11 +152,6 @@ class Model:
             ["text-generation-launcher"] + LAUNCH_FLAGS
         )
         self.client = AsyncClient("http://127.0.0.1:8000", timeout=60)
-        self.template = """<s>[INST] <<SYS>>
-{system}
-<</SYS>>
-
-{user} [/INST] """
 
         # Poll until webserver at 127.0.0.1:8000 accepts connections before running inputs.
         def webserver_ready():
@@ -157,17 +178,17 @@ class Model:
 
     @method()
     async def generate(self, question: str):
-        prompt = self.template.format(system="", user=question)
-        result = await self.client.generate(prompt, max_new_tokens=1024)
+        prompt = format_prompt(question)
+        result = await self.client.generate(prompt, **GENERATION_PARAMS)
 
         return result.generated_text
 
     @method()
     async def generate_stream(self, question: str):
-        prompt = self.template.format(system="", user=question)
+        prompt = format_prompt(question)
 
         async for response in self.client.generate_stream(
-            prompt, max_new_tokens=1024
+            prompt, **GENERATION_PARAMS
         ):
             if not response.token.special:
                 yield response.token.text
@@ -185,56 +206,350 @@ def main():
     )
 
 
+# ## Caching completions
+#
+# Popular questions get asked over and over, and since our generation settings are deterministic, the same
+# prompt always produces the same completion. There's no need to generate it twice. Better still, if we answer repeated questions in the web app in front
+# of the model, they never have to reach a GPU at all.
+#
+# Completions are keyed by the model revision, the prompt and the generation parameters. Whitespace in the prompt
+# is collapsed for the key only, so the same question typed with different spacing is a hit, while the model
+# still sees the question exactly as it was asked. Each completion is stored as a small file in a persisted
+# [`Volume`](/docs/guide/volumes), which the web app reads directly, so the cache outlives the web app's container.
+# In front of the volume, each web app container keeps its most recently used completions in memory, so the most
+# popular questions don't even need a file read. Whenever it commits the volume, the web app also prunes it: files
+# older than `CACHE_MAX_AGE_SECONDS` go, and then the oldest files beyond `CACHE_MAX_FILES`.
+# Hits, misses and the number of tokens we didn't have to generate are reported by the `/stats` endpoint.
+
+stub.volume = Volume.persisted("example-tgi-completion-cache")
+CACHE_DIR = Path("/cache")
+CACHE_COMMIT_INTERVAL = 60  # seconds between commits of new cache entries
+CACHE_MAX_FILES = 100_000
+CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+MEMORY_CACHE_SIZE = 1024  # completions kept in memory by each web app container
+
+
+def cache_key(prompt: str, params: dict) -> str:
+    normalized = " ".join(prompt.split())
+    payload = json.dumps([REVISION, normalized, params], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def read_cached(key: str) -> Optional[dict]:
+    path = CACHE_DIR / f"{key}.json"
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def write_cached(key: str, text: str, num_tokens: int) -> dict:
+    entry = {"text": text, "num_tokens": num_tokens}
+    (CACHE_DIR / f"{key}.json").write_text(json.dumps(entry))
+    return entry
+
+
+def prune_cached() -> int:
+    files = []
+    for path in CACHE_DIR.glob("*.json"):
+        try:
+            files.append((path.stat().st_mtime, path))
+        except FileNotFoundError:  # pruned by another container
+            continue
+    files.sort()
+    cutoff = time.time() - CACHE_MAX_AGE_SECONDS
+    expired = sum(1 for mtime, _ in files if mtime < cutoff)
+    remove = max(expired, len(files) - CACHE_MAX_FILES)
+    for _, path in files[:remove]:
+        path.unlink(missing_ok=True)
+    return remove
+
+
+# ## Admission control
+#
+# Without any control in front of it, the web app forwards every request straight to the model, and under
+# heavy load every user waits longer and longer for their first token. Instead, we let a limited number of
+# requests through to the model at once and queue the rest in the web app:
+#
+# - The queue is fair between clients: whenever a slot frees up, it goes to the next client in round-robin
+#   order, so one client sending many requests can't starve everyone else.
+# - We have a latency objective for the time to first token. If the queue is already so long that a new
+#   request can't expect to meet it, we reject the request right away with a `503` and a `Retry-After`
+#   header. A request that has waited in the queue for longer than the objective is shed the same way.
+# - The concurrency limit adapts to what we observe. Every few seconds we look at the model's backlog and
+#   number of containers from `get_current_stats`, and at the rolling 95th percentile time to first token.
+#   If we're missing the objective, the limit is cut back. If requests are queueing here while the model has
+#   no backlog, there's spare capacity and the limit goes up by one. The limit never goes much beyond what
+#   the running containers can take, plus one more container's worth to let the autoscaler add capacity.
+#
+# The rolling percentiles, the queue depth and the current limit are all exported through `/stats`.
+
+TTFT_SLO_SECONDS = 5.0
+TTFT_WINDOW_SECONDS = 60.0
+ADJUST_INTERVAL_SECONDS = 5.0
+MAX_CONCURRENCY = 100
+
+
+class AdmissionController:
+    def __init__(self, limit: int, ttft_slo: float):
+        self.limit = limit
+        self.ttft_slo = ttft_slo
+        self.active = 0
+        self.queues: collections.OrderedDict = collections.OrderedDict()
+        self.ttfts: collections.deque = collections.deque()
+        self.rejected = 0
+        self.shed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self.queues.values())
+
+    def percentile(self, q: float) -> Optional[float]:
+        cutoff = time.monotonic() - TTFT_WINDOW_SECONDS
+        while self.ttfts and self.ttfts[0][0] < cutoff:
+            self.ttfts.popleft()
+        if not self.ttfts:
+            return None
+        values = sorted(ttft for _, ttft in self.ttfts)
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+    def record_ttft(self, seconds: float):
+        self.ttfts.append((time.monotonic(), seconds))
+
+    async def acquire(self, client: str) -> bool:
+        if self.active < self.limit and not self.queues:
+            self.active += 1
+            return True
+
+        p50 = self.percentile(50)
+        if (
+            p50 is not None
+            and (self.queue_depth / self.limit + 1) * p50 > self.ttft_slo
+        ):
+            self.rejected += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(client, collections.deque()).append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.ttft_slo)
+        except asyncio.TimeoutError:
+            if waiter.done():  # we were let in just as we gave up
+                return True
+            self._remove(client, waiter)
+            self.shed += 1
+            return False
+        except asyncio.CancelledError:  # the client went away while queued
+            if waiter.done():
+                self.release()
+            else:
+                self._remove(client, waiter)
+            raise
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _remove(self, client: str, waiter: asyncio.Future):
+        waiters = self.queues[client]
+        waiters.remove(waiter)
+        if not waiters:
+            del self.queues[client]
+
+    def _dispatch(self):
+        while self.active < self.limit and self.queues:
+            client, waiters = next(iter(self.queues.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self.queues.move_to_end(client)
+            else:
+                del self.queues[client]
+            waiter.set_result(None)
+            self.active += 1
+
+    def adjust(self, backlog: int, num_runners: int):
+        p95 = self.percentile(95)
+        if p95 is not None and p95 > self.ttft_slo:
+            self.limit = max(1, int(self.limit * 0.8))
+        elif backlog == 0 and self.queue_depth > 0:
+            self.limit += 1
+        ceiling = (max(num_runners, 1) + 1) * MODEL_CONCURRENT_INPUTS
+        self.limit = min(self.limit, ceiling, MAX_CONCURRENCY)
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "ttft_p50": self.percentile(50),
+            "ttft_p95": self.percentile(95),
+            "rejected": self.rejected,
+            "shed": self.shed,
+        }
+
+
 # ## Serve the model
 # Once we deploy this model with `modal deploy text_generation_inference.py`, we can serve it
 # behind an ASGI app front-end. The front-end code (a single file of Alpine.js) is available
 # [here](https://github.com/modal-labs/modal-examples/blob/main/06_gpu_and_ml/llm-frontend/index.html).
 #
+# The web app checks the completion cache before streaming a new completion from the model, and caches
+# the completion once it's done. A cached completion is sent as a single event, without waiting for
+# admission. Since requests now queue in the web app, we let it accept many more of them at once.
+# Each container of the web app runs its own admission controller.
+#
+# The web app is a class, so that it can commit the cache volume when its container shuts down, as well as
+# every `CACHE_COMMIT_INTERVAL` seconds while it runs. A request gives its admission slot back when its
+# response ends, however it ends: after the last token, when streaming fails, or when the client hangs up
+# before streaming has even started.
+#
 # You can try our deployment [here](https://modal-labs--tgi-app.modal.run).
 
 frontend_path = Path(__file__).parent / "llm-frontend"
 
 
-@stub.function(
+@stub.cls(
     mounts=[Mount.from_local_dir(frontend_path, remote_path="/assets")],
+    volumes={CACHE_DIR: stub.volume},
     keep_warm=1,
-    allow_concurrent_inputs=10,
+    allow_concurrent_inputs=MAX_CONCURRENCY,
     timeout=60 * 10,
 )
-@asgi_app(label="tgi-app")
-def app():
-    import json
-
-    import fastapi
-    import fastapi.staticfiles
-    from fastapi.responses import StreamingResponse
-
-    web_app = fastapi.FastAPI()
-
-    @web_app.get("/stats")
-    async def stats():
-        stats = await Model().generate_stream.get_current_stats.aio()
-        return {
-            "backlog": stats.backlog,
-            "num_total_runners": stats.num_total_runners,
-        }
-
-    @web_app.get("/completion/{question}")
-    async def completion(question: str):
-        from urllib.parse import unquote
-
-        async def generate():
-            async for text in Model().generate_stream.remote_gen.aio(
-                unquote(question)
-            ):
-                yield f"data: {json.dumps(dict(text=text), ensure_ascii=False)}\n\n"
-
-        return StreamingResponse(generate(), media_type="text/event-stream")
+class WebApp:
+    def __enter__(self):
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.admission = AdmissionController(
+            MODEL_CONCURRENT_INPUTS, TTFT_SLO_SECONDS
+        )
+        self.cache_stats = {"hits": 0, "misses": 0, "saved_tokens": 0}
+        self.recent: collections.OrderedDict = collections.OrderedDict()
+        self.last_commit = time.monotonic()
+        self.adjust_task = None
 
-    web_app.mount(
-        "/", fastapi.staticfiles.StaticFiles(directory="/assets", html=True)
-    )
-    return web_app
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        prune_cached()
+        stub.volume.commit()
+
+    async def maybe_commit(self):
+        if time.monotonic() - self.last_commit > CACHE_COMMIT_INTERVAL:
+            self.last_commit = time.monotonic()
+            await asyncio.to_thread(prune_cached)
+            await stub.volume.commit.aio()
+
+    async def adjust_forever(self):
+        while True:
+            stats = await Model().generate_stream.get_current_stats.aio()
+            self.admission.adjust(stats.backlog, stats.num_total_runners)
+            await asyncio.sleep(ADJUST_INTERVAL_SECONDS)
+
+    def remember(self, key: str, entry: dict):
+        self.recent[key] = entry
+        self.recent.move_to_end(key)
+        while len(self.recent) > MEMORY_CACHE_SIZE:
+            self.recent.popitem(last=False)
+
+    def lookup(self, key: str) -> Optional[dict]:
+        entry = self.recent.get(key)
+        if entry is not None:
+            self.recent.move_to_end(key)
+        elif (entry := read_cached(key)) is not None:
+            self.remember(key, entry)
+        if entry is None:
+            self.cache_stats["misses"] += 1
+        else:
+            self.cache_stats["hits"] += 1
+            self.cache_stats["saved_tokens"] += entry["num_tokens"]
+        return entry
+
+    @asgi_app(label="tgi-app")
+    def app(self):
+        import json
+
+        import fastapi
+        import fastapi.staticfiles
+        from fastapi.responses import StreamingResponse
+        from starlette.background import BackgroundTask
+
+        web_app = fastapi.FastAPI()
+        admission = self.admission
+
+        @web_app.get("/stats")
+        async def stats():
+            stats = await Model().generate_stream.get_current_stats.aio()
+            lookups = self.cache_stats["hits"] + self.cache_stats["misses"]
+            hit_rate = self.cache_stats["hits"] / lookups if lookups else 0.0
+            return {
+                "backlog": stats.backlog,
+                "num_total_runners": stats.num_total_runners,
+                "cache": {**self.cache_stats, "hit_rate": hit_rate},
+                "admission": admission.stats(),
+            }
+
+        @web_app.get("/completion/{question}")
+        async def completion(question: str, request: fastapi.Request):
+            from urllib.parse import unquote
+
+            if self.adjust_task is None or self.adjust_task.done():
+                self.adjust_task = asyncio.create_task(self.adjust_forever())
+
+            question = unquote(question)
+            key = cache_key(format_prompt(question), GENERATION_PARAMS)
+
+            def event(text):
+                return f"data: {json.dumps(dict(text=text), ensure_ascii=False)}\n\n"
+
+            if entry := self.lookup(key):
+                return StreamingResponse(
+                    iter([event(entry["text"])]),
+                    media_type="text/event-stream",
+                )
+
+            forwarded_for = request.headers.get("x-forwarded-for")
+            client = (
+                (forwarded_for or request.client.host).split(",")[0].strip()
+            )
+            arrived_at = time.monotonic()
+            if not await admission.acquire(client):
+                raise fastapi.HTTPException(
+                    status_code=503,
+                    detail="Too many requests in the queue, please retry later.",
+                    headers={"Retry-After": str(int(TTFT_SLO_SECONDS))},
+                )
+
+            released = False
+
+            def release():
+                nonlocal released
+                if not released:
+                    released = True
+                    admission.release()
+
+            async def generate():
+                texts = []
+                try:
+                    async for text in Model().generate_stream.remote_gen.aio(
+                        question
+                    ):
+                        if not texts:
+                            admission.record_ttft(time.monotonic() - arrived_at)
+                        texts.append(text)
+                        yield event(text)
+                finally:
+                    release()
+                self.remember(
+                    key, write_cached(key, "".join(texts), len(texts))
+                )
+                await self.maybe_commit()
+
+            return StreamingResponse(
+                generate(),
+                media_type="text/event-stream",
+                background=BackgroundTask(release),
+            )
+
+        web_app.mount(
+            "/", fastapi.staticfiles.StaticFiles(directory="/assets", html=True)
+        )
+        return web_app
 
 
 # ## Invoke the model from other apps
@@ -86,8 +86,7 @@ class Config:
 #
 # The `fastai` framework famously requires very little code to get things done,
 # so our downloading function is very short and simple. The CIFAR-10 dataset is
-# also not large, about 150MB, so we don't bother persisting it in a network file system
-# and just download and unpack it to ephemeral disk.
+# also not large, about 150MB, so we just download and unpack it to ephemeral disk.
 
 
 def download_dataset():
@@ -98,6 +97,201 @@ def download_dataset():
     return path
 
 
+# ## Decoding the dataset once
+#
+# CIFAR-10 ships as 60,000 tiny PNG files. Decoding them again in every epoch, as a
+# file-based fastai `DataBlock` would, keeps the CPU busy while the GPU waits.
+# Instead, we decode every image exactly once, in parallel, into a single uint8 NumPy
+# array per split, which we save in the network file system next to our models.
+# Later training runs skip both the download and the decoding, and read images
+# straight out of the memory-mapped arrays.
+#
+# The arrays are written to a temporary name and renamed when complete, and the
+# `vocab.json` file is written last, so an interrupted run never leaves behind a
+# cache that looks complete.
+
+DATASET_CACHE = pathlib.Path(MODEL_CACHE, "cifar10-uint8")
+IMAGE_SIZE = 32  # the size of every image in CIFAR-10
+
+
+def decode_image(path: pathlib.Path):
+    import numpy as np
+    import PIL.Image
+
+    with PIL.Image.open(path) as img:
+        return np.asarray(img.convert("RGB"))
+
+
+def build_dataset_cache(dataset_path: pathlib.Path, cache_dir: pathlib.Path):
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    import numpy as np
+
+    vocab = sorted(
+        p.name for p in (dataset_path / "train").iterdir() if p.is_dir()
+    )
+    label_ids = {name: i for i, name in enumerate(vocab)}
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor() as pool:
+        for split in ("train", "test"):
+            files = sorted((dataset_path / split).glob("*/*.png"))
+            tmp_path = cache_dir / f"{split}_images.tmp.npy"
+            images = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(files), IMAGE_SIZE, IMAGE_SIZE, 3),
+            )
+            for i, pixels in enumerate(
+                pool.map(decode_image, files, chunksize=256)
+            ):
+                images[i] = pixels
+            images.flush()
+            del images
+            tmp_path.rename(cache_dir / f"{split}_images.npy")
+            labels = [label_ids[f.parent.name] for f in files]
+            np.save(cache_dir / f"{split}_labels.npy", np.array(labels))
+            print(f"Decoded {len(files)} {split} images into {cache_dir}.")
+    (cache_dir / "vocab.json").write_text(json.dumps(vocab))
+
+
+@stub.function(
+    image=image,
+    network_file_systems={str(MODEL_CACHE): volume},
+    cpu=8,
+    timeout=1800,
+)
+def prepare_dataset():
+    if (DATASET_CACHE / "vocab.json").exists():
+        print(f"Found decoded CIFAR-10 dataset in {DATASET_CACHE}.")
+        return
+    build_dataset_cache(download_dataset(), DATASET_CACHE)
+
+
+# ## Loading batches from the cache
+#
+# `CifarArrays` is a plain map-style dataset over one split of the cache. Reading an
+# item is just a copy of 3KB out of the memory-mapped array, so a few DataLoader worker
+# processes, which share the mapping, keep up with the GPU easily.
+#
+# We never resize individual images. The cache holds the original 32x32 pixels, and
+# each batch is converted to floats and resized in one `F.interpolate` call after
+# it has been moved to the GPU. That way the same cache serves every image size we
+# train on, and the 224x224 epochs cost the data loader no more than the 32x32 ones.
+# We also normalize with the ImageNet statistics our pretrained model expects here,
+# so the test set loader gets the same treatment as the training loaders.
+
+NUM_WORKERS = 6
+
+
+class CifarArrays:
+    def __init__(self, cache_dir: pathlib.Path, split: str, indices=None):
+        import numpy as np
+
+        self.images = np.load(cache_dir / f"{split}_images.npy", mmap_mode="r")
+        self.labels = np.load(cache_dir / f"{split}_labels.npy")
+        if indices is None:
+            indices = np.arange(len(self.labels))
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        import numpy as np
+
+        j = self.indices[i]
+        return np.asarray(self.images[j]), self.labels[j]
+
+
+def resize_batch(images, size: int):
+    """Turn a batch of NHWC uint8 images into NCHW floats of the given size."""
+    import torch.nn.functional as F
+
+    x = images.permute(0, 3, 1, 2).float().div_(255)
+    if x.shape[-1] != size:
+        x = F.interpolate(
+            x, size=(size, size), mode="bilinear", align_corners=False
+        )
+    return x.contiguous()
+
+
+def cifar_dataloaders(
+    cache_dir: pathlib.Path,
+    size: int,
+    bs: int = 64,
+    valid_pct: float = 0.2,
+    num_workers: int = NUM_WORKERS,
+    seed: int = 42,
+):
+    """Returns training/validation `DataLoaders` and a test `DataLoader`."""
+    import numpy as np
+    from fastai.data.core import DataLoaders, TfmdDL
+    from fastai.torch_core import TensorCategory, TensorImage, default_device
+    from fastai.vision.all import Normalize, imagenet_stats
+    from fastcore.transform import ItemTransform
+
+    class ToImageBatch(ItemTransform):
+        def encodes(self, batch):
+            images, labels = batch
+            return TensorImage(resize_batch(images, size)), TensorCategory(
+                labels
+            )
+
+    def loader(dataset, train: bool):
+        return TfmdDL(
+            dataset,
+            bs=bs,
+            shuffle=train,
+            drop_last=train,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=True,
+            after_batch=[
+                ToImageBatch(),
+                Normalize.from_stats(*imagenet_stats),
+            ],
+            device=default_device(),
+        )
+
+    n = len(np.load(cache_dir / "train_labels.npy"))
+    order = np.random.default_rng(seed).permutation(n)
+    n_valid = int(n * valid_pct)
+    dls = DataLoaders(
+        loader(CifarArrays(cache_dir, "train", order[n_valid:]), train=True),
+        loader(CifarArrays(cache_dir, "train", order[:n_valid]), train=False),
+    )
+    return dls, loader(CifarArrays(cache_dir, "test"), train=False)
+
+
+# The exported model is used to classify arbitrary images, not items of our cache, so
+# before exporting we swap in `DataLoaders` with fastai's usual image pipeline. fastai
+# needs an item to set the pipeline up with, so we give it a single blank image.
+
+
+def inference_dataloaders(vocab: List[str], size: int):
+    import numpy as np
+    from fastai.vision.all import (
+        CategoryBlock,
+        DataBlock,
+        ImageBlock,
+        ItemGetter,
+        Normalize,
+        Resize,
+        imagenet_stats,
+    )
+
+    dblock = DataBlock(
+        blocks=(ImageBlock(), CategoryBlock(vocab=vocab)),
+        getters=[ItemGetter(0), ItemGetter(1)],
+        item_tfms=Resize(size),
+        batch_tfms=Normalize.from_stats(*imagenet_stats),
+    )
+    blank = np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)
+    return dblock.dataloaders([(blank, vocab[0])], bs=1)
+
+
 # ## Training a vision model with FastAI
 #
 # To address the CIFAR-10 image classification problem, we use the high-level fastAI framework
@@ -129,6 +323,9 @@ def download_dataset():
 #
 # `MODAL_GPU=any modal run --detach vision_model_training.py::stub.train`
 #
+# The training container first makes sure the decoded dataset exists, then copies it
+# from the network file system to local disk, so the worker processes read it at
+# local disk speed (and, after the first epoch, from the page cache).
 
 
 @stub.function(
@@ -136,26 +333,26 @@ def download_dataset():
     gpu=USE_GPU,
     network_file_systems={str(MODEL_CACHE): volume},
     secret=Secret.from_name("wandb"),
+    cpu=NUM_WORKERS + 2,
     timeout=2700,  # 45 minutes
 )
 def train():
+    import json
+    import shutil
+
     import wandb
     from fastai.callback.wandb import WandbCallback
-    from fastai.data.transforms import parent_label
+    from fastai.losses import CrossEntropyLossFlat
     from fastai.metrics import accuracy
-    from fastai.vision.all import Resize, models, vision_learner
-    from fastai.vision.data import (
-        CategoryBlock,
-        DataBlock,
-        ImageBlock,
-        TensorCategory,
-        get_image_files,
-    )
+    from fastai.vision.all import models, vision_learner
 
     config: Config = Config()
 
-    print("Downloading dataset")
-    dataset_path = download_dataset()
+    print("Preparing dataset")
+    prepare_dataset.remote()
+    cache_dir = pathlib.Path("/tmp", DATASET_CACHE.name)
+    shutil.copytree(DATASET_CACHE, cache_dir, dirs_exist_ok=True)
+    vocab = json.loads((cache_dir / "vocab.json").read_text())
 
     wandb_enabled = bool(os.environ.get("WANDB_API_KEY"))
     if wandb_enabled:
@@ -170,30 +367,22 @@ def train():
 
     for dim in config.img_dims:
         print(f"Training on {dim}x{dim} size images.")
-        dblock = DataBlock(
-            blocks=(ImageBlock(), CategoryBlock()),
-            get_items=get_image_files,
-            get_y=parent_label,
-            item_tfms=Resize(dim),
-        )
-
-        dls = dblock.dataloaders(dataset_path, bs=64)
+        dls, test_dl = cifar_dataloaders(cache_dir, dim)
 
         learn = vision_learner(
-            dls, models.resnet18, metrics=accuracy, cbs=callbacks
+            dls,
+            models.resnet18,
+            n_out=len(vocab),
+            loss_func=CrossEntropyLossFlat(),
+            metrics=accuracy,
+            cbs=callbacks,
         ).to_fp16()
         learn.fine_tune(config.epochs, freeze_epochs=3)
         learn.save(f"cifar10_{dim}")
 
         # run on test set
-        test_files = get_image_files(dataset_path / "test")
-        label = TensorCategory(
-            [dls.vocab.o2i[parent_label(f)] for f in test_files]
-        )
-
-        test_set = learn.dls.test_dl(test_files)
-        pred = learn.get_preds(0, test_set)
-        acc = accuracy(pred[0], label).item()
+        preds, targets = learn.get_preds(dl=test_dl)
+        acc = accuracy(preds, targets).item()
         print(f"{dim}x{dim}, test accuracy={acc}")
 
     # 🐝 Close wandb run
@@ -205,7 +394,9 @@ def train():
     learn.remove_cbs(
         WandbCallback
     )  # Added W&B callback is not compatible with inference.
+    learn.dls = inference_dataloaders(vocab, dim)
     learn.export(MODEL_EXPORT_PATH)
+    save_torchscript(learn.model, vocab, dim, TORCHSCRIPT_EXPORT_PATH)
 
 
 # ## Trained model plumbing
@@ -214,7 +405,110 @@ def train():
 # amount of harness code that loads the saved model from persistent
 # disk once on container start.
 #
-# The model's predict function accepts an image as bytes or a numpy array.
+# fastai's `Learner.predict` handles one image at a time and runs it through
+# fastai's whole transform pipeline. For serving, we only need the underlying PyTorch
+# model, so we do the preprocessing ourselves: each image is decoded, center-cropped
+# and resized to the training size with PIL, then the whole batch is normalized with
+# a single vectorized NumPy operation and classified in one forward pass.
+#
+# Images may be given as encoded bytes, NumPy arrays or PIL images.
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+TOP_K = 3
+
+
+def preprocess(images, size: int):
+    """Returns the images as one normalized NCHW float32 array."""
+    import io
+
+    import numpy as np
+    import PIL.Image
+    import PIL.ImageOps
+
+    def load(image):
+        if isinstance(image, bytes):
+            image = PIL.Image.open(io.BytesIO(image))
+        elif isinstance(image, np.ndarray):
+            image = PIL.Image.fromarray(image)
+        return PIL.ImageOps.fit(
+            image.convert("RGB"), (size, size), PIL.Image.BILINEAR
+        )
+
+    batch = np.stack([np.asarray(load(image)) for image in images])
+    mean = np.array(IMAGENET_MEAN, dtype=np.float32) * 255
+    std = np.array(IMAGENET_STD, dtype=np.float32) * 255
+    batch = (batch - mean) / std
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+def classify(model, batch, vocab: List[str], k: int = TOP_K):
+    """Returns the top `k` labels and their probabilities for each image."""
+    import torch
+
+    with torch.inference_mode():
+        probs = model(torch.from_numpy(batch)).softmax(dim=-1)
+    top = probs.topk(min(k, len(vocab)), dim=-1)
+    return [
+        {vocab[i]: p for p, i in zip(ps.tolist(), ids.tolist())}
+        for ps, ids in zip(top.values, top.indices)
+    ]
+
+
+# ### Exporting to TorchScript
+#
+# Without fastai in the loop, the model can also be compiled to TorchScript. We trace
+# it on CPU and freeze it, which folds the batch norm layers into the convolutions
+# and drops the Python overhead of running each module. The labels and input size
+# are saved in the same file, so loading it needs neither fastai nor the learner.
+
+TORCHSCRIPT_EXPORT_PATH = MODEL_EXPORT_PATH.with_name(
+    "inference.torchscript.pt"
+)
+
+
+def save_torchscript(model, vocab: List[str], size: int, path: pathlib.Path):
+    import json
+
+    import torch
+
+    model = model.cpu().eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros(1, 3, size, size))
+        frozen = torch.jit.freeze(traced)
+    extra_files = {"vocab.json": json.dumps(vocab), "size": str(size)}
+    torch.jit.save(frozen, str(path), _extra_files=extra_files)
+
+
+def load_torchscript(path: pathlib.Path):
+    import json
+
+    import torch
+
+    extra_files = {"vocab.json": "", "size": ""}
+    model = torch.jit.load(str(path), _extra_files=extra_files)
+    vocab = json.loads(extra_files["vocab.json"])
+    return model, vocab, int(extra_files["size"])
+
+
+@stub.function(
+    image=image,
+    network_file_systems={str(MODEL_CACHE): volume},
+)
+def export_torchscript():
+    from fastai.learner import load_learner
+
+    learn = load_learner(MODEL_EXPORT_PATH)
+    size = Config.img_dims[-1]  # the learner was exported for the last size
+    save_torchscript(
+        learn.model, list(learn.dls.vocab), size, TORCHSCRIPT_EXPORT_PATH
+    )
+    print(f"Exported TorchScript model to {TORCHSCRIPT_EXPORT_PATH}.")
+
+
+# The classifier prefers the TorchScript export when there is one, and falls back to
+# the fastai learner otherwise. Either way, it runs one forward pass on start-up so
+# the first real request doesn't pay for the lazy initialization in PyTorch.
 
 
 @stub.cls(
@@ -223,31 +517,153 @@ def train():
 )
 class ClassifierModel:
     def __enter__(self):
+        import numpy as np
         from fastai.learner import load_learner
 
-        self.model = load_learner(MODEL_EXPORT_PATH)
+        if TORCHSCRIPT_EXPORT_PATH.exists():
+            self.model, self.vocab, self.size = load_torchscript(
+                TORCHSCRIPT_EXPORT_PATH
+            )
+        else:
+            learn = load_learner(MODEL_EXPORT_PATH)
+            self.model = learn.model.eval()
+            self.vocab = list(learn.dls.vocab)
+            self.size = Config.img_dims[-1]
+        warmup_images = [np.zeros((self.size, self.size, 3), dtype=np.uint8)]
+        self.top_labels(warmup_images, k=1)
+
+    def top_labels(self, images: list, k: int) -> List[dict]:
+        return classify(
+            self.model, preprocess(images, self.size), self.vocab, k
+        )
+
+    @method()
+    def predict_batch(self, images: list, k: int = TOP_K) -> List[dict]:
+        return self.top_labels(images, k)
 
     @method()
     def predict(self, image) -> str:
-        prediction = self.model.predict(image)
-        classification = prediction[0]
-        return classification
+        (top_labels,) = self.top_labels([image], k=1)
+        return next(iter(top_labels))
 
 
 @stub.function(
     image=image,
 )
 def classify_url(image_url: str) -> None:
-    """Utility function for command-line classification runs."""
+    """Utility function for command-line classification runs.
+
+    Several comma-separated URLs are classified in a single batch."""
     import httpx
 
-    r = httpx.get(image_url)
-    if r.status_code != 200:
-        raise RuntimeError(f"Could not download '{image_url}'")
+    urls = image_url.split(",")
+    with httpx.Client() as client:
+        responses = [client.get(url) for url in urls]
+    for url, r in zip(urls, responses):
+        if r.status_code != 200:
+            raise RuntimeError(f"Could not download '{url}'")
 
     classifier = ClassifierModel()
-    label = classifier.predict.remote(image=r.content)
-    print(f"Classification: {label}")
+    predictions = classifier.predict_batch.remote(
+        [r.content for r in responses]
+    )
+    for url, top_labels in zip(urls, predictions):
+        labels = ", ".join(
+            f"{label} ({p:.0%})" for label, p in top_labels.items()
+        )
+        print(f"{url}: {labels}")
+
+
+# ### Benchmarking on CPU
+#
+# `modal run vision_model_training.py --benchmark` compares three ways of classifying
+# a batch of images on your own CPU (you'll need fastai installed locally): fastai's
+# `Learner.predict` one image at a time, `classify` with the PyTorch model, and
+# `classify` with its TorchScript export. A randomly initialised ResNet-18 with
+# the same head as our trained model stands in for it.
+
+
+@stub.local_entrypoint()
+def main(
+    benchmark: bool = False,
+    num_images: int = 32,
+    size: int = 224,
+    rounds: int = 3,
+):
+    if benchmark:
+        run_benchmark(num_images, size, rounds)
+        return
+
+    print(
+        "Train with `modal run vision_model_training.py::stub.train`, or pass"
+        " --benchmark to compare the ways of classifying images on your CPU."
+    )
+
+
+def run_benchmark(num_images: int, size: int, rounds: int):
+    import io
+    import tempfile
+    import time
+
+    import numpy as np
+    import PIL.Image
+    from fastai.learner import Learner
+    from fastai.losses import CrossEntropyLossFlat
+    from fastai.vision.all import create_vision_model, models
+
+    vocab = [f"class_{i}" for i in range(10)]
+    model = create_vision_model(
+        models.resnet18, n_out=len(vocab), pretrained=False
+    ).eval()
+    learn = Learner(
+        inference_dataloaders(vocab, size),
+        model,
+        loss_func=CrossEntropyLossFlat(),
+    )
+
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_images):
+        height, width = rng.integers(64, 512, size=2)
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        buf = io.BytesIO()
+        PIL.Image.fromarray(pixels).save(buf, format="PNG")
+        images.append(buf.getvalue())
+
+    def fastai_predict():
+        with learn.no_bar():
+            return [learn.predict(image)[0] for image in images]
+
+    def batched(model):
+        def run():
+            top_labels = classify(model, preprocess(images, size), vocab, k=1)
+            return [next(iter(labels)) for labels in top_labels]
+
+        return run
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir, "model.pt")
+        save_torchscript(model, vocab, size, path)
+        scripted, _, _ = load_torchscript(path)
+
+    reference = fastai_predict()  # also warms up
+    baseline = None
+    for name, run in [
+        ("Learner.predict", fastai_predict),
+        ("batched", batched(model)),
+        ("batched, TorchScript", batched(scripted)),
+    ]:
+        labels = run()
+        t0 = time.monotonic()
+        for _ in range(rounds):
+            run()
+        elapsed = (time.monotonic() - t0) / rounds
+        baseline = baseline or elapsed
+        agreement = np.mean([a == b for a, b in zip(labels, reference)])
+        print(
+            f"{name:>21}: {num_images / elapsed:6.1f} images/s,"
+            f" {baseline / elapsed:4.1f}x, top-1 agreement {agreement:.0%}"
+        )
 
 
 # ## Wrap the trained model in Gradio's web UI
@@ -257,7 +673,7 @@ def classify_url(image_url: str) -> None:
 #
 # This model is an image classifier, so we set up an interface that
 # accepts an image via drag-and-drop and uses the trained model to
-# output a classification label.
+# output the most likely labels, with their probabilities.
 #
 # Remember, this model was trained on tiny CIFAR-10 images so it's
 # going to perform best against similarly simple and scaled-down images.
@@ -274,16 +690,17 @@ def create_demo_examples() -> List[str]:
         "modal.jpg": "https://pbs.twimg.com/profile_images/1567270019075031040/Hnrebn0M_400x400.jpg",
     }
     available_examples = []
-    for dest, url in example_imgs.items():
-        filepath = pathlib.Path(dest)
-        r = httpx.get(url)
-        if r.status_code != 200:
-            print(f"Could not download '{url}'", file=sys.stderr)
-            continue
-
-        with open(filepath, "wb") as f:
-            f.write(r.content)
-        available_examples.append(str(filepath))
+    with httpx.Client() as client:
+        for dest, url in example_imgs.items():
+            filepath = pathlib.Path(dest)
+            r = client.get(url)
+            if r.status_code != 200:
+                print(f"Could not download '{url}'", file=sys.stderr)
+                continue
+
+            with open(filepath, "wb") as f:
+                f.write(r.content)
+            available_examples.append(str(filepath))
     return available_examples
 
 
@@ -298,8 +715,13 @@ def fastapi_app():
     from gradio.routes import mount_gradio_app
 
     classifier = ClassifierModel()
+
+    def classify_image(image):
+        (top_labels,) = classifier.predict_batch.remote([image])
+        return top_labels
+
     interface = gr.Interface(
-        fn=classifier.predict.remote,
+        fn=classify_image,
         inputs=gr.Image(shape=(224, 224)),
         outputs="label",
         examples=create_demo_examples(),
@@ -326,6 +748,13 @@ def fastapi_app():
 # modal run vision_model_training.py::stub.classify_url --image-url <url>
 # ```
 #
+# Training also exports the model to TorchScript. To export a model that was trained
+# before that, run:
+#
+# ```shell
+# modal run vision_model_training.py::stub.export_torchscript
+# ```
+#
 # To run the Gradio server, run:
 #
 # ```shell
@@ -18,9 +18,19 @@
 #
 # First we import the components we need from `modal`.
 
+import asyncio
+import collections
+import hashlib
+import inspect
+import itertools
+import json
 import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
 
-from modal import Image, Secret, Stub, method
+from modal import Image, Secret, Stub, Volume, method, web_endpoint
 
 MODEL_DIR = "/model"
 BASE_MODEL = "mistralai/Mistral-7B-Instruct-v0.1"
@@ -79,6 +89,232 @@ image = (
 
 stub = Stub("example-vllm-inference", image=image)
 
+# We also create a persisted [`Volume`](/docs/guide/volumes) to hold cached completions, as described below.
+
+stub.volume = Volume.persisted("example-vllm-inference-cache")
+CACHE_DIR = Path("/cache")
+
+
+# ## Continuous batching
+#
+# vLLM gets its throughput from batching: every step of the engine generates one more token for each
+# of the requests it is working on, and new requests can join the batch between any two steps. To let
+# concurrent callers share that batch, we put a small request-level scheduler in front of the engine.
+#
+# Callers `submit` a prompt with its sampling parameters and get back a `Request` whose tokens they can
+# stream as they are generated. A single background task moves newly submitted requests into the
+# engine, runs engine steps, and routes each step's outputs to the right request. Along the way it
+# records when each request was submitted, produced its first token and finished, so we can report
+# time-to-first-token and tokens per second for every request.
+#
+# The scheduler only relies on three methods of the engine (`add_request`, `step` and
+# `has_unfinished_requests`), so it works the same with vLLM's `LLMEngine` as with a fake engine that
+# emits made-up tokens on a CPU.
+
+
+@dataclass
+class Request:
+    id: str
+    prompt: str
+    sampling_params: Any
+    prefix_pos: Optional[int] = None
+    submitted_at: float = field(default_factory=time.monotonic)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    text: str = ""
+    num_tokens: int = 0
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.submitted_at
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.finished_at is None or self.first_token_at is None:
+            return None
+        elapsed = self.finished_at - self.first_token_at
+        return self.num_tokens / elapsed if elapsed > 0 else None
+
+    async def stream(self) -> AsyncIterator[str]:
+        while True:
+            delta = await self.queue.get()
+            if delta is None:
+                return
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+
+    async def result(self) -> str:
+        return "".join([delta async for delta in self.stream()])
+
+
+class Scheduler:
+    def __init__(self, engine):
+        self.engine = engine
+        self.pending: collections.deque = collections.deque()
+        self.running: dict = {}
+        self.ids = itertools.count()
+        # Created in `submit`, so that they belong to the event loop serving requests.
+        self.wakeup: Optional[asyncio.Event] = None
+        self.loop_task: Optional[asyncio.Task] = None
+
+    async def submit(
+        self, prompt: str, sampling_params, prefix_pos: Optional[int] = None
+    ) -> Request:
+        request = Request(
+            str(next(self.ids)), prompt, sampling_params, prefix_pos
+        )
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.pending.append(request)
+        self.wakeup.set()
+        if self.loop_task is None or self.loop_task.done():
+            self.loop_task = asyncio.create_task(self.run())
+        return request
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Requests join the running batch between engine steps.
+            while self.pending:
+                request = self.pending.popleft()
+                extra = {}
+                if request.prefix_pos is not None:
+                    extra["prefix_pos"] = request.prefix_pos
+                self.engine.add_request(
+                    request.id, request.prompt, request.sampling_params, **extra
+                )
+                self.running[request.id] = request
+
+            if not self.engine.has_unfinished_requests():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            try:
+                # The engine step blocks on the GPU, so keep it off the event loop.
+                outputs = await loop.run_in_executor(None, self.engine.step)
+            except Exception as exc:
+                for request in self.running.values():
+                    request.queue.put_nowait(exc)
+                self.running.clear()
+                raise
+
+            now = time.monotonic()
+            for output in outputs:
+                request = self.running[output.request_id]
+                completion = output.outputs[0]
+                if len(completion.token_ids) > request.num_tokens:
+                    if request.first_token_at is None:
+                        request.first_token_at = now
+                    request.num_tokens = len(completion.token_ids)
+                if len(completion.text) > len(request.text):
+                    request.queue.put_nowait(
+                        completion.text[len(request.text) :]
+                    )
+                    request.text = completion.text
+                if output.finished:
+                    request.finished_at = now
+                    request.queue.put_nowait(None)
+                    del self.running[output.request_id]
+
+
+# ## Caching completions
+#
+# Every question is wrapped in the same `[INST]` template, and the same questions tend to come up again
+# and again. When sampling is deterministic (a temperature of zero), the same prompt always produces the
+# same completion, so there's no need to generate it twice.
+#
+# `CompletionCache` keys completions by the model, the prompt and the sampling parameters. Whitespace in
+# the prompt is collapsed for the key only, so the same question typed with different spacing is a hit,
+# while the model still sees the question exactly as it was asked. Recently used completions are kept in
+# memory, with the least recently used ones evicted once there are too many, and every completion is also
+# written to the volume, which is committed when the container shuts down, so that it outlives the
+# container. Completions written by other containers become visible to a container the next time it
+# starts. So that the volume doesn't grow forever, containers prune it when they start and shut down:
+# files older than `max_age` seconds go, and then the oldest files beyond `max_files`. Hits, misses and the number of tokens we didn't have to generate are counted for the `/stats`
+# endpoint further down.
+
+
+class CompletionCache:
+    def __init__(
+        self,
+        directory: Path,
+        model: str,
+        max_entries: int = 1024,
+        max_files: int = 100_000,
+        max_age: float = 30 * 24 * 60 * 60,
+    ):
+        self.directory = directory
+        self.model = model
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self.max_age = max_age
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, prompt: str, sampling_params: str) -> str:
+        normalized = " ".join(prompt.split())
+        payload = json.dumps([self.model, normalized, sampling_params])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif (self.directory / f"{key}.json").exists():
+            entry = json.loads((self.directory / f"{key}.json").read_text())
+            self._remember(key, entry)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.saved_tokens += entry["num_tokens"]
+        return entry
+
+    def put(self, key: str, text: str, num_tokens: int):
+        entry = {"text": text, "num_tokens": num_tokens}
+        self._remember(key, entry)
+        (self.directory / f"{key}.json").write_text(json.dumps(entry))
+
+    def _remember(self, key: str, entry: dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def prune(self) -> int:
+        files = []
+        for path in self.directory.glob("*.json"):
+            try:
+                files.append((path.stat().st_mtime, path))
+            except FileNotFoundError:  # pruned by another container
+                continue
+        files.sort()
+        cutoff = time.time() - self.max_age
+        expired = sum(1 for mtime, _ in files if mtime < cutoff)
+        remove = max(expired, len(files) - self.max_files)
+        for _, path in files[:remove]:
+            path.unlink(missing_ok=True)
+        return remove
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "cached_completions": len(self.entries),
+        }
+
 
 # ## The model class
 #
@@ -86,47 +322,140 @@ stub = Stub("example-vllm-inference", image=image)
 # This enables us to load the model into memory just once every time a container starts up, and keep it cached
 # on the GPU for each subsequent invocation of the function.
 #
-# The `vLLM` library allows the code to remain quite clean.
-@stub.cls(gpu="A100", secret=Secret.from_name("huggingface"))
+# We load the model into vLLM's `LLMEngine` and hand it to our scheduler. Since the container accepts
+# many inputs at once, concurrent calls to `generate` and `generate_stream` all end up in the same batch.
+# `generate` returns the completions along with their timing stats, and `generate_stream` streams the
+# text of a single completion as it's generated. Deterministic requests are answered from the completion
+# cache when possible.
+#
+# All prompts also start with the same system prefix. We count its tokens once, and if the engine supports
+# sharing the KV cache of a common prompt prefix between requests (via a `prefix_pos` argument to
+# `add_request`), we pass that along so the prefix is only computed once.
+@stub.cls(
+    gpu="A100",
+    secret=Secret.from_name("huggingface"),
+    allow_concurrent_inputs=20,
+    volumes={CACHE_DIR: stub.volume},
+)
 class Model:
     def __enter__(self):
-        from vllm import LLM
+        from vllm import EngineArgs, LLMEngine, SamplingParams
 
         # Load the model. Tip: MPT models may require `trust_remote_code=true`.
-        self.llm = LLM(MODEL_DIR)
+        engine = LLMEngine.from_engine_args(EngineArgs(model=MODEL_DIR))
+        self.scheduler = Scheduler(engine)
+        self.cache = CompletionCache(CACHE_DIR, BASE_MODEL)
+        self.cache.prune()
         self.template = """<s>[INST] <<SYS>>
 {system}
 <</SYS>>
 
 {user} [/INST] """
-
-    @method()
-    def generate(self, user_questions):
-        from vllm import SamplingParams
-
-        prompts = [
-            self.template.format(system="", user=q) for q in user_questions
-        ]
-
-        sampling_params = SamplingParams(
+        self.sampling_params = SamplingParams(
             temperature=0.75,
             top_p=1,
             max_tokens=800,
             presence_penalty=1.15,
         )
-        result = self.llm.generate(prompts, sampling_params)
-        num_tokens = 0
-        for output in result:
-            num_tokens += len(output.outputs[0].token_ids)
-            print(output.prompt, output.outputs[0].text, "\n\n", sep="")
-        print(f"Generated {num_tokens} tokens")
+
+        self.prefix_pos = None
+        if "prefix_pos" in inspect.signature(engine.add_request).parameters:
+            prefix = self.template.split("{user}")[0].format(system="")
+            tokenizer = engine.tokenizer
+            self.prefix_pos = len(tokenizer(prefix).input_ids)
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.cache.prune()
+        stub.volume.commit()
+
+    def _prompt(self, question: str) -> str:
+        return self.template.format(system="", user=question)
+
+    def _cache_key(self, prompt: str, sampling_params) -> Optional[str]:
+        if sampling_params.temperature > 0:
+            return None  # sampled completions differ from call to call
+        return self.cache.key(prompt, repr(sampling_params))
+
+    async def _complete(self, question: str, sampling_params) -> dict:
+        prompt = self._prompt(question)
+        key = self._cache_key(prompt, sampling_params)
+        if key and (entry := self.cache.get(key)):
+            return {"question": question, **entry, "cached": True}
+
+        request = await self.scheduler.submit(
+            prompt, sampling_params, self.prefix_pos
+        )
+        text = await request.result()
+        if key:
+            self.cache.put(key, text, request.num_tokens)
+        return {
+            "question": question,
+            "text": text,
+            "num_tokens": request.num_tokens,
+            "time_to_first_token": request.time_to_first_token,
+            "tokens_per_second": request.tokens_per_second,
+            "cached": False,
+        }
+
+    @method()
+    async def generate(self, user_questions, sampling_params=None):
+        sampling_params = sampling_params or self.sampling_params
+        results = await asyncio.gather(
+            *(self._complete(q, sampling_params) for q in user_questions)
+        )
+        generated = sum(r["num_tokens"] for r in results if not r["cached"])
+        print(f"Generated {generated} tokens")
+        return results
+
+    @method()
+    async def generate_stream(self, question: str, sampling_params=None):
+        sampling_params = sampling_params or self.sampling_params
+        prompt = self._prompt(question)
+        key = self._cache_key(prompt, sampling_params)
+        if key and (entry := self.cache.get(key)):
+            yield entry["text"]
+            return
+
+        request = await self.scheduler.submit(
+            prompt, sampling_params, self.prefix_pos
+        )
+        async for delta in request.stream():
+            yield delta
+        if key:
+            self.cache.put(key, request.text, request.num_tokens)
+
+    # Cache statistics are served from a web endpoint. Each container keeps its own counts,
+    # so these describe the container that happens to serve the request.
+    @web_endpoint()
+    def stats(self):
+        return self.cache.stats()
 
 
 # ## Run the model
 # We define a [`local_entrypoint`](/docs/guide/apps#entrypoints-for-ephemeral-apps) to call our remote function
-# sequentially for a list of inputs. You can run this locally with `modal run vllm_inference.py`.
+# for a list of inputs, and print each completion with its stats. You can run this locally with `modal run vllm_inference.py`.
+#
+# A completion can lack some of its stats: one served from the cache wasn't timed, and one whose tokens all
+# arrived in a single engine step has no measurable rate. We only print the stats we have.
+
+
+def describe(result: dict) -> str:
+    if result["cached"]:
+        return f"{result['num_tokens']} tokens, from the cache"
+    parts = [f"{result['num_tokens']} tokens"]
+    if result["time_to_first_token"] is not None:
+        parts.append(f"first token after {result['time_to_first_token']:.2f}s")
+    if result["tokens_per_second"] is not None:
+        parts.append(f"{result['tokens_per_second']:.1f} tokens/s")
+    return ", ".join(parts)
+
+
 @stub.local_entrypoint()
-def main():
+def main(self_test: bool = False):
+    if self_test:
+        asyncio.run(test_scheduler())
+        return
+
     model = Model()
     questions = [
         # Coding questions
@@ -195,4 +524,88 @@ def main():
         "Who were the 'Dog-Headed Saint' and the 'Lion-Faced Saint' in medieval Christian traditions?",
         "What is the story of the 'Globsters', unidentified organic masses washed up on the shores?",
     ]
-    model.generate.remote(questions)
+    for result in model.generate.remote(questions):
+        print(result["question"], result["text"], sep="\n", end="\n\n")
+        print(describe(result), end="\n\n")
+
+
+# ## Testing without a GPU
+#
+# `modal run vllm_inference.py --self-test` runs the scheduler locally against a fake engine, which
+# generates one made-up word per step for every request it holds, and finishes each request after as
+# many words as its sampling parameters ask for. The test checks that concurrent requests are batched
+# into the same engine steps, that each request streams exactly its own text, and that the stats come
+# out as expected.
+
+
+class FakeEngine:
+    def __init__(self):
+        self.requests: dict = {}
+        self.batch_sizes: list = []
+
+    def add_request(self, request_id, prompt, sampling_params, prefix_pos=None):
+        self.requests[request_id] = (prompt, sampling_params, [])
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self.requests)
+
+    def step(self):
+        from types import SimpleNamespace
+
+        time.sleep(0.01)
+        self.batch_sizes.append(len(self.requests))
+        outputs = []
+        for request_id, (prompt, max_tokens, words) in list(
+            self.requests.items()
+        ):
+            words.append(f"{prompt}-{len(words)}")
+            finished = len(words) == max_tokens
+            if finished:
+                del self.requests[request_id]
+            completion = SimpleNamespace(
+                text=" ".join(words), token_ids=list(range(len(words)))
+            )
+            outputs.append(
+                SimpleNamespace(
+                    request_id=request_id,
+                    outputs=[completion],
+                    finished=finished,
+                )
+            )
+        return outputs
+
+
+async def test_scheduler():
+    engine = FakeEngine()
+    scheduler = Scheduler(engine)
+    lengths = {"a": 5, "b": 3, "c": 8}
+    requests = [
+        await scheduler.submit(prompt, max_tokens)
+        for prompt, max_tokens in lengths.items()
+    ]
+    texts = await asyncio.gather(*(request.result() for request in requests))
+
+    for (prompt, max_tokens), request, text in zip(
+        lengths.items(), requests, texts
+    ):
+        assert text == " ".join(f"{prompt}-{i}" for i in range(max_tokens))
+        assert request.num_tokens == max_tokens
+        assert request.time_to_first_token is not None
+        assert request.tokens_per_second is not None
+    assert engine.batch_sizes[0] == len(lengths), engine.batch_sizes
+    assert len(engine.batch_sizes) == max(lengths.values()), engine.batch_sizes
+
+    # A request whose only token arrives in its last step has no rate.
+    request = await scheduler.submit("d", 1)
+    assert await request.result() == "d-0"
+    assert request.tokens_per_second is None
+    result = {
+        "cached": False,
+        "num_tokens": request.num_tokens,
+        "time_to_first_token": request.time_to_first_token,
+        "tokens_per_second": request.tokens_per_second,
+    }
+    print(describe(result))
+    print(
+        f"Scheduled {len(lengths) + 1} requests in {len(engine.batch_sizes)} steps"
+    )
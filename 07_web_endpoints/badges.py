@@ -8,28 +8,74 @@
 #
 # First let's start off by creating a Modal stub, and defining an image with the Python packages we're going to be using:
 
-from modal import Image, Stub, web_endpoint
+import asyncio
+import hashlib
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Optional
+
+from fastapi import Header, Response
+from modal import Dict, Image, Period, Stub, web_endpoint
 
 stub = Stub(
     "example-web-badges",
     image=Image.debian_slim().pip_install("pybadges", "pypistats"),
 )
 
-# ## Defining the web endpoint
+# ## Caching badges
 #
-# In addition to using `@stub.function()` to decorate our function, we use the
-# `@modal.web_endpoint` decorator ([learn more](/docs/guide/webhooks#web_endpoint)), which instructs Modal
-# to create a REST endpoint that serves this function. Note that the default method is `GET`, but this
-# can be overridden using the `method` argument.
+# Download counts change at most once a day, but badges are embedded in READMEs and fetched constantly,
+# so we don't want to query `pypistats` and render a new SVG on every request. We cache rendered badges
+# at several levels:
+#
+# 1. Each container keeps the most recently used badges in memory, in a small LRU cache.
+# 2. All containers share a [`Dict`](/docs/reference/modal.Dict) of badges, which a scheduled function keeps
+#    fresh for the most requested packages.
+# 3. Every response carries an `ETag` and a `Cache-Control` header, so browsers and CDNs can keep their own
+#    copy and revalidate it cheaply: if the badge hasn't changed, we answer with an empty `304 Not Modified`.
 
+BADGE_TTL_SECONDS = 60 * 60
+LRU_SIZE = 1024
+CACHE_CONTROL = (
+    f"public, max-age={BADGE_TTL_SECONDS}, stale-while-revalidate=86400"
+)
 
-@stub.function()
-@web_endpoint()
-async def package_downloads(package_name: str):
+stub.badges = Dict.new()  # package name -> (rendered_at, svg, etag)
+stub.badge_requests = Dict.new()  # "counts" -> {package name: request count}
+
+badge_lru: OrderedDict[str, tuple[float, bytes, str]] = OrderedDict()
+
+
+def cache_get(package_name: str) -> Optional[tuple[float, bytes, str]]:
+    entry = badge_lru.get(package_name)
+    if entry is None or time.time() - entry[0] > BADGE_TTL_SECONDS:
+        return None
+    badge_lru.move_to_end(package_name)
+    return entry
+
+
+def cache_put(package_name: str, entry: tuple[float, bytes, str]) -> None:
+    badge_lru[package_name] = entry
+    badge_lru.move_to_end(package_name)
+    while len(badge_lru) > LRU_SIZE:
+        badge_lru.popitem(last=False)
+
+
+# ## Rendering badges
+#
+# We use `pypistats` to query the most recent stats for a package, and then
+# use that as the text for a SVG badge, rendered using `pybadges`. The ETag is a hash of the rendered SVG.
+#
+# `pypistats` is a blocking library, so we run each lookup in a thread. That lets us fetch stats for
+# several packages at once: `render_badges` deduplicates the names it's given and fetches all of them
+# concurrently. A package that fails to render (say, because it doesn't exist) gets its exception
+# instead of a badge, without failing the others.
+
+
+def render_badge(package_name: str) -> tuple[float, bytes, str]:
     import json
 
     import pypistats
-    from fastapi import Response
     from pybadges import badge
 
     stats = json.loads(pypistats.recent(package_name, format="json"))
@@ -37,15 +83,200 @@ async def package_downloads(package_name: str):
         left_text=f"{package_name} downloads",
         right_text=str(stats["data"]["last_month"]),
         right_color="blue",
+    ).encode()
+    etag = '"' + hashlib.sha256(svg).hexdigest()[:16] + '"'
+    return time.time(), svg, etag
+
+
+async def render_badges(package_names) -> dict[str, Any]:
+    names = sorted(set(package_names))
+    entries = await asyncio.gather(
+        *(asyncio.to_thread(render_badge, name) for name in names),
+        return_exceptions=True,
     )
+    return dict(zip(names, entries))
+
+
+# ## Defining the web endpoint
+#
+# In addition to using `@stub.function()` to decorate our function, we use the
+# `@modal.web_endpoint` decorator ([learn more](/docs/guide/webhooks#web_endpoint)), which instructs Modal
+# to create a REST endpoint that serves this function. Note that the default method is `GET`, but this
+# can be overridden using the `method` argument.
+#
+# We let each container serve many requests concurrently, so they all share its in-memory cache. Badges
+# that need rendering are collected for `BATCH_WINDOW_SECONDS` and then rendered together: one
+# `render_badges` call and one write of all the new badges to the shared `Dict`, however many packages
+# were requested. Requests for the same badge share one render.
+
+BATCH_WINDOW_SECONDS = 0.05
+
+pending_renders: dict[str, asyncio.Future] = {}
+batch_task: Optional[asyncio.Task] = None
 
-    return Response(content=svg, media_type="image/svg+xml")
 
+async def render_pending() -> None:
+    global batch_task
+    await asyncio.sleep(BATCH_WINDOW_SECONDS)
+    batch = dict(pending_renders)
+    pending_renders.clear()
+    batch_task = None
+
+    try:
+        entries = await render_badges(batch)
+        rendered = {
+            name: entry
+            for name, entry in entries.items()
+            if not isinstance(entry, Exception)
+        }
+        if rendered:
+            await stub.badges.update.aio(**rendered)
+    except Exception as exc:
+        entries = {name: exc for name in batch}
+
+    for name, future in batch.items():
+        if isinstance(entries[name], Exception):
+            future.set_exception(entries[name])
+        else:
+            future.set_result(entries[name])
+
+
+async def get_badge(package_name: str) -> tuple[float, bytes, str]:
+    global batch_task
+    count_request(package_name)
+    if entry := cache_get(package_name):
+        return entry
+
+    try:
+        entry = await stub.badges.get.aio(package_name)
+    except KeyError:
+        entry = None
+    if entry is None or time.time() - entry[0] > BADGE_TTL_SECONDS:
+        render = pending_renders.get(package_name)
+        if render is None:
+            render = asyncio.get_running_loop().create_future()
+            pending_renders[package_name] = render
+            if batch_task is None:
+                batch_task = asyncio.create_task(render_pending())
+        entry = await asyncio.shield(render)
+
+    cache_put(package_name, entry)
+    return entry
+
+
+# Clients may send several ETags in `If-None-Match`, or `*` for any, and caches may mark the ETags they
+# pass on as weak with a `W/` prefix. Since we only use it to skip sending the body again, we compare
+# ETags weakly, ignoring that prefix.
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return opaque(etag) in {opaque(tag) for tag in if_none_match.split(",")}
+
+
+@stub.function(allow_concurrent_inputs=20)
+@web_endpoint()
+async def package_downloads(
+    package_name: str, if_none_match: Optional[str] = Header(None)
+):
+    _, svg, etag = await get_badge(package_name)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=svg, media_type="image/svg+xml", headers=headers)
+
+
+# Since Modal web endpoints are FastAPI functions under the hood, we return the SVG wrapped in a FastAPI response
+# with the correct media type. Also note that FastAPI automatically interprets `package_name` as a
+# [query param](https://fastapi.tiangolo.com/tutorial/query-params/), and the `If-None-Match` header as `if_none_match`.
+
+# ## Refreshing popular badges
+#
+# Finally, a scheduled function re-renders badges for the most requested packages in one batch, before
+# their cached copies expire. Requests for those packages are then always served from the shared cache.
+#
+# To know which packages are popular, `get_badge` counts every request for each package, whether it was
+# served from a cache or not, so that the packages we keep fresh keep their place on the list. Each container
+# collects its counts in memory, and adds them to the shared counts at most every `COUNT_FLUSH_SECONDS`.
+# The counts are only a rough guide (two containers updating them at once can lose an update, and a
+# container that shuts down loses its last few counts), which is all we need here. So that packages that
+# were popular once don't stay on the list forever, every refresh halves all the counts, and forgets
+# packages whose count has dropped below `MIN_REQUEST_COUNT`.
+
+POPULAR_PACKAGES = 100
+REQUEST_DECAY = 0.5
+MIN_REQUEST_COUNT = 0.1
+COUNT_FLUSH_SECONDS = 60
+
+request_counts: Counter = Counter()
+last_flush = time.monotonic()
+flush_task: Optional[asyncio.Task] = None
+
+
+async def load_request_counts() -> dict[str, float]:
+    try:
+        return await stub.badge_requests.get.aio("counts")
+    except KeyError:
+        return {}
+
+
+async def flush_request_counts() -> None:
+    global flush_task
+    new_counts = dict(request_counts)
+    request_counts.clear()
+    try:
+        counts = await load_request_counts()
+        for name, count in new_counts.items():
+            counts[name] = counts.get(name, 0) + count
+        await stub.badge_requests.put.aio("counts", counts)
+    finally:
+        flush_task = None
+
+
+def count_request(package_name: str) -> None:
+    global last_flush, flush_task
+    request_counts[package_name] += 1
+    if (
+        flush_task is None
+        and time.monotonic() - last_flush > COUNT_FLUSH_SECONDS
+    ):
+        last_flush = time.monotonic()
+        flush_task = asyncio.create_task(flush_request_counts())
+
+
+@stub.function(schedule=Period(minutes=30))
+async def refresh_badges():
+    counts = await load_request_counts()
+    # decay first, so that counts flushed while we render aren't overwritten.
+    decayed = {name: count * REQUEST_DECAY for name, count in counts.items()}
+    await stub.badge_requests.put.aio(
+        "counts",
+        {
+            name: count
+            for name, count in decayed.items()
+            if count >= MIN_REQUEST_COUNT
+        },
+    )
+
+    names = sorted(counts, key=counts.__getitem__, reverse=True)
+    names = names[:POPULAR_PACKAGES]
+    rendered = {
+        name: entry
+        for name, entry in (await render_badges(names)).items()
+        if not isinstance(entry, Exception)
+    }
+    if rendered:
+        await stub.badges.update.aio(**rendered)
+    print(f"Refreshed badges for {len(rendered)} of {len(names)} packages")
 
-# In this function, we use `pypistats` to query the most recent stats for our package, and then
-# use that as the text for a SVG badge, rendered using `pybadges`.
-# Since Modal web endpoints are FastAPI functions under the hood, we return this SVG wrapped in a FastAPI response with the correct media type.
-# Also note that FastAPI automatically interprets `package_name` as a [query param](https://fastapi.tiangolo.com/tutorial/query-params/).
 
 # ## Running and deploying
 #
@@ -11,12 +11,19 @@ Modal function running on the GPU.
 The weights of the model are saved in the image, so they don't need to be
 downloaded again while the app is running.
 
-Chat history tensors are saved in a `modal.Dict` distributed dictionary.
+Each container keeps the attention key/value cache of its most recent chat
+sessions in memory, so a new turn only runs the model over the new message
+instead of the whole conversation. Chat histories are also saved as token ids
+in a `modal.Dict` distributed dictionary, so any container can pick up a
+session, and are truncated to a fixed token budget so turns don't get slower
+as conversations grow.
 """
 
+import collections
 import uuid
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, List, Optional, Tuple
 
 import fastapi
 from fastapi.responses import JSONResponse
@@ -72,28 +79,148 @@ def transformer():
     return app
 
 
-@stub.function(gpu="any", image=stub.gpu_image)
+HISTORY_TOKEN_BUDGET = 768  # DialoGPT attends over at most 1024 positions
+MAX_RESPONSE_TOKENS = 256
+# Share of the GPU memory left free after loading the model that cached sessions
+# may take up. The rest is headroom for the activations of the forward passes.
+SESSION_CACHE_MEMORY_FRACTION = 0.5
+
+
+@dataclass
+class Session:
+    token_ids: List[int]
+    past_key_values: Any = None  # covers the first `num_cached` token ids
+    num_cached: int = 0
+
+
+class SessionCache:
+    """Least-recently-used cache of chat sessions, keyed by chat id.
+
+    The key/value cache of a session grows with its length, so the cache is
+    bounded by the total number of cached tokens rather than by sessions.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.num_tokens = 0
+        self.sessions: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, id: str) -> Optional[Session]:
+        session = self.sessions.get(id)
+        if session is not None:
+            self.sessions.move_to_end(id)
+        return session
+
+    def put(self, id: str, session: Session):
+        if id in self.sessions:
+            self.num_tokens -= self.sessions.pop(id).num_cached
+        self.sessions[id] = session
+        self.num_tokens += session.num_cached
+        while self.num_tokens > self.max_tokens and len(self.sessions) > 1:
+            _, evicted = self.sessions.popitem(last=False)
+            self.num_tokens -= evicted.num_cached
+
+
+def session_cache_token_budget(model) -> int:
+    """How many tokens of key/value cache fit in the GPU's free memory.
+
+    Each token keeps a key and a value vector per layer. For DialoGPT-large in
+    fp32 that's about 370KB, so a session at the full history budget takes
+    about 280MB, and we can't afford a fixed number of sessions on every GPU
+    that `gpu="any"` might give us.
+    """
+    config = model.config
+    bytes_per_token = (
+        2
+        * config.n_layer
+        * config.n_embd
+        * next(model.parameters()).element_size()
+    )
+    free_bytes, _ = torch.cuda.mem_get_info(model.device)
+    return int(free_bytes * SESSION_CACHE_MEMORY_FRACTION) // bytes_per_token
+
+
+def truncate_history(token_ids: List[int], eos_id: int) -> List[int]:
+    """Drop the oldest turns of a history that is over budget.
+
+    We cut down to half the budget, so that we only have to recompute the
+    (now shifted) key/value cache once every few turns.
+    """
+    start = len(token_ids) - HISTORY_TOKEN_BUDGET // 2
+    for boundary in range(start, len(token_ids) - 1):
+        if token_ids[boundary - 1] == eos_id:  # prefer to cut between turns
+            return token_ids[boundary:]
+    return token_ids[start:]
+
+
+if stub.is_inside(stub.gpu_image):
+    sessions = SessionCache(session_cache_token_budget(model))
+
+
+# Sessions are only cached in the memory of the container that last served
+# them, so we keep containers around for a while after the last request, which
+# makes it likely that the next turn of a conversation finds its cache warm.
+# When it doesn't, or when another container has served the session in the
+# meantime, the container rebuilds the session from the token ids in the
+# `modal.Dict`, which always has the full history.
+
+
+@stub.function(gpu="any", image=stub.gpu_image, container_idle_timeout=60 * 10)
 def generate_response(
     message: str, id: Optional[str] = None
 ) -> Tuple[str, str]:
-    new_input_ids = tokenizer.encode(
-        message + tokenizer.eos_token, return_tensors="pt"
-    ).to("cuda")
-    if id is not None:
-        chat_history = stub.chat_histories[id]
-        bot_input_ids = torch.cat([chat_history, new_input_ids], dim=-1)
-    else:
-        id = str(uuid.uuid4())
-        bot_input_ids = new_input_ids
-
-    chat_history = model.generate(
-        bot_input_ids, max_length=1250, pad_token_id=tokenizer.eos_token_id
-    )
-    response = tokenizer.decode(
-        chat_history[:, bot_input_ids.shape[-1] :][0], skip_special_tokens=True
+    eos_id = tokenizer.eos_token_id
+    new_ids = tokenizer.encode(message + tokenizer.eos_token)
+
+    session = sessions.get(id) if id is not None else None
+    if id is not None and stub.chat_histories.contains(id):
+        # Another container may have served this session since we cached it,
+        # in which case our cache is missing turns: start again from the
+        # shared history.
+        history = stub.chat_histories[id]
+        if session is None or session.token_ids != history:
+            session = Session(token_ids=history)
+    if session is None:
+        id = id or str(uuid.uuid4())
+        session = Session(token_ids=[])
+
+    token_ids = session.token_ids + new_ids
+    if len(token_ids) > HISTORY_TOKEN_BUDGET:
+        token_ids = truncate_history(token_ids, eos_id)
+        session = Session(token_ids=[])  # positions shifted, drop the cache
+
+    # Run the model over the tokens that aren't in the cache yet, then generate
+    # the response greedily one token at a time, extending the cache as we go.
+    past_key_values = session.past_key_values
+    input_ids = token_ids[session.num_cached :]
+    response_ids: List[int] = []
+    with torch.inference_mode():
+        while True:
+            output = model(
+                torch.tensor([input_ids], device=model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = output.past_key_values
+            next_id = int(output.logits[0, -1].argmax())
+            response_ids.append(next_id)
+            if next_id == eos_id or len(response_ids) >= MAX_RESPONSE_TOKENS:
+                break
+            input_ids = [next_id]
+
+    # The last generated token hasn't been run through the model yet.
+    token_ids = token_ids + response_ids
+    sessions.put(
+        id,
+        Session(
+            token_ids=token_ids,
+            past_key_values=past_key_values,
+            num_cached=len(token_ids) - 1,
+        ),
     )
+    stub.chat_histories[id] = token_ids
 
-    stub.chat_histories[id] = chat_history
+    response = tokenizer.decode(response_ids, skip_special_tokens=True)
     return id, response
 
 
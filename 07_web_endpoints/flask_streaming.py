@@ -2,14 +2,21 @@
 # lambda-test: false
 # ---
 
+import time
+
 import modal
 from modal import wsgi_app
 
 stub = modal.Stub(
     "example-web-flask-stream",
-    image=modal.Image.debian_slim().pip_install("flask"),
+    image=modal.Image.debian_slim().pip_install("flask", "numpy"),
 )
 
+NUM_ROWS = 10_000
+NUM_COLUMNS = 128
+CHUNK_SIZE = 64 * 1024  # bytes
+BLOCK_ROWS = 64
+
 
 @stub.function()
 def generate_rows():
@@ -17,26 +24,90 @@ def generate_rows():
     This creates a large CSV file, about 10MB, which will be streaming downloaded
     by a web client.
     """
-    for i in range(10_000):
-        line = ",".join(str((j + i) * i) for j in range(128))
+    for i in range(NUM_ROWS):
+        line = ",".join(str((j + i) * i) for j in range(NUM_COLUMNS))
         yield f"{line}\n"
 
 
+# Yielding one short line at a time means 10,000 messages, each with its own
+# overhead, whether they go to the web client or between containers. Instead,
+# `generate_chunks` computes a block of rows at a time with NumPy, formats the
+# whole block with a single `%` operation rather than joining one string per
+# value, and yields the bytes once it has about 64KB. With `gzip=True` the
+# chunks are compressed as they go, at the fastest compression level, which
+# still shrinks this repetitive CSV to under half its size.
+
+
+@stub.function()
+def generate_chunks(gzip: bool = False):
+    """
+    Streams the same CSV file as `generate_rows`, in chunks of about 64KB.
+    """
+    import zlib
+
+    import numpy as np
+
+    compressor = zlib.compressobj(1, wbits=31) if gzip else None  # gzip format
+    columns = np.arange(NUM_COLUMNS, dtype=np.int64)
+    row_format = ",".join(["%d"] * NUM_COLUMNS) + "\n"
+    buf = bytearray()
+
+    def take_chunk() -> bytes:
+        chunk = bytes(buf)
+        buf.clear()
+        return compressor.compress(chunk) if compressor else chunk
+
+    for start in range(0, NUM_ROWS, BLOCK_ROWS):
+        i = np.arange(start, min(start + BLOCK_ROWS, NUM_ROWS), dtype=np.int64)
+        block = (columns + i[:, None]) * i[:, None]
+        buf += (
+            row_format * len(block) % tuple(block.ravel().tolist())
+        ).encode()
+        if len(buf) >= CHUNK_SIZE:
+            chunk = take_chunk()
+            if chunk:
+                yield chunk
+    chunk = take_chunk()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
 @stub.function()
 @wsgi_app()
 def flask_app():
-    from flask import Flask
+    from flask import Flask, request
 
     web_app = Flask(__name__)
 
     # These web handlers follow the example from
     # https://flask.palletsprojects.com/en/2.2.x/patterns/streaming/
 
+    def accepts_gzip() -> bool:
+        # The quality the client gives gzip, which is 0 for "gzip;q=0", and
+        # also covers a "*" wildcard.
+        return request.accept_encodings["gzip"] > 0
+
+    def csv_headers(gzip: bool):
+        # The response depends on Accept-Encoding, which caches need to know.
+        headers = {"Content-Type": "text/csv", "Vary": "Accept-Encoding"}
+        if gzip:
+            headers["Content-Encoding"] = "gzip"
+        return headers
+
     @web_app.route("/")
     def generate_large_csv():
         # Run the function locally in the web app's container.
         return generate_rows.local(), {"Content-Type": "text/csv"}
 
+    @web_app.route("/chunked")
+    def generate_large_csv_in_chunks():
+        # Same, but in chunks of about 64KB, and compressed if the client
+        # accepts it.
+        gzip = accepts_gzip()
+        return generate_chunks.local(gzip=gzip), csv_headers(gzip)
+
     @web_app.route("/remote")
     def generate_large_csv_in_container():
         # Run the function remotely in a separate container,
@@ -45,7 +116,36 @@ def flask_app():
         #
         # This is less efficient, but demonstrates how web serving
         # containers can be separated from and cooperate with other
-        # containers.
-        return generate_rows.remote(), {"Content-Type": "text/csv"}
+        # containers. Sending large chunks, compressed if the client
+        # accepts it, keeps the number of messages between the two
+        # containers small.
+        gzip = accepts_gzip()
+        return generate_chunks.remote_gen(gzip=gzip), csv_headers(gzip)
 
     return web_app
+
+
+# ## Benchmark
+#
+# `modal run flask_streaming.py::benchmark` compares how fast the two
+# generators produce the CSV on your machine (you'll need NumPy installed).
+
+
+@stub.local_entrypoint()
+def benchmark():
+    csv_size = sum(len(row) for row in generate_rows.local())
+    for name, generator in [
+        ("per-row", lambda: generate_rows.local()),
+        ("chunked", lambda: generate_chunks.local()),
+        ("chunked, gzip", lambda: generate_chunks.local(gzip=True)),
+    ]:
+        t0 = time.monotonic()
+        num_bytes = num_messages = 0
+        for message in generator():
+            num_bytes += len(message)
+            num_messages += 1
+        elapsed = time.monotonic() - t0
+        print(
+            f"{name:>14}: {num_messages:6d} messages, {num_bytes / 1e6:5.1f}MB sent,"
+            f" {csv_size / 1e6 / elapsed:6.1f}MB/s of CSV"
+        )
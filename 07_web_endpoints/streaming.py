@@ -4,6 +4,7 @@
 # ---
 import asyncio
 import time
+from typing import AsyncIterator, Union
 
 from fastapi import FastAPI
 from fastapi.responses import StreamingResponse
@@ -44,6 +45,66 @@ def fastapi_app():
     return web_app
 
 
+# ## Streaming results from other Modal functions
+#
+# The next two endpoints stream results produced by *other* Modal functions. We
+# pass those results through a small adapter, `stream_frames`, which does three
+# things:
+#
+# * It reads results ahead of the client, up to `prefetch` of them, in a background task.
+# * Whenever the client is ready for more data, it sends everything that has
+#   arrived since the last send as a single chunk (up to `max_frame_bytes`),
+#   instead of one tiny message per result.
+# * The read-ahead buffer is bounded, so if the client reads slowly, the background
+#   task stops pulling results until the client catches up, rather than buffering
+#   them without limit. `StreamingResponse` only asks for the next chunk once
+#   the previous one has been written to the socket.
+
+
+async def stream_frames(
+    results: AsyncIterator[Union[str, bytes]],
+    prefetch: int = 64,
+    max_frame_bytes: int = 64 * 1024,
+) -> AsyncIterator[bytes]:
+    queue: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+    done = object()
+
+    async def read_ahead():
+        try:
+            async for result in results:
+                await queue.put(
+                    result.encode() if isinstance(result, str) else result
+                )
+        except Exception as exc:
+            await queue.put(exc)
+        await queue.put(done)
+
+    reader = asyncio.create_task(read_ahead())
+    try:
+        finished = False
+        while not finished:
+            items = [await queue.get()]  # wait for at least one result
+            size = 0
+            while not queue.empty() and size < max_frame_bytes:
+                item = queue.get_nowait()
+                items.append(item)
+                if isinstance(item, bytes):
+                    size += len(item)
+
+            frame = []
+            for item in items:
+                if item is done:
+                    finished = True
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    frame.append(item)
+            if frame:
+                yield b"".join(frame)
+    finally:
+        reader.cancel()
+
+
 # This `hook` web endpoint Modal function calls *another* Modal function,
 # and it just works!
 
@@ -57,27 +118,86 @@ def sync_fake_video_streamer():
 
 @stub.function()
 @web_endpoint()
-def hook():
+async def hook():
     return StreamingResponse(
-        sync_fake_video_streamer.remote_gen(), media_type="text/event-stream"
+        stream_frames(sync_fake_video_streamer.remote_gen.aio()),
+        media_type="text/event-stream",
     )
 
 
 # This `mapped` web endpoint Modal function does a parallel `.map` on a simple
 # Modal function. Using `.starmap` also would work in the same fashion.
+#
+# With `order_outputs=False`, results are streamed in the order they finish,
+# so a slow input doesn't hold back the results of the inputs after it.
 
 
 @stub.function()
 def map_me(i):
-    time.sleep(i)  # stagger the results for demo purposes
+    time.sleep(10 - i)  # stagger the results for demo purposes
     return f"hello from {i}\n"
 
 
 @stub.function()
 @web_endpoint()
-def mapped():
+async def mapped():
     return StreamingResponse(
-        map_me.map(range(10)), media_type="text/event-stream"
+        stream_frames(map_me.map.aio(range(10), order_outputs=False)),
+        media_type="text/event-stream",
+    )
+
+
+# ## Testing the adapter locally
+#
+# `modal run streaming.py::test_stream_frames` feeds `stream_frames` from fake
+# producers and checks that:
+#
+# * every result comes out exactly once, in order,
+# * results that arrive while a slow client is busy are sent together, as one frame,
+# * while the client stalls, the producer is pulled at most `prefetch` results ahead
+#   (plus the one it's waiting to put in the full buffer).
+
+
+async def fake_results(delays, counter=None):
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        if counter is not None:
+            counter["produced"] += 1
+        yield f"result {i}\n"
+
+
+def split_results(frames: list[bytes]) -> list[str]:
+    return b"".join(frames).decode().splitlines(keepends=True)
+
+
+@stub.local_entrypoint()
+async def test_stream_frames():
+    # Results arrive at staggered times, while the client reads slowly.
+    delays = [0.0, 0.01, 0.01, 0.3, 0.0, 0.0, 0.2, 0.01]
+    expected = [f"result {i}\n" for i in range(len(delays))]
+    frames = []
+    async for frame in stream_frames(fake_results(delays), prefetch=4):
+        frames.append(frame)
+        await asyncio.sleep(0.1)  # a slow client
+    assert split_results(frames) == expected, frames
+    assert len(frames) < len(delays), "results were not coalesced"
+    assert any(len(split_results([frame])) > 1 for frame in frames)
+
+    # A fast producer and a client that stalls after its first frame.
+    prefetch = 4
+    counter = {"produced": 0}
+    frames = []
+    async for frame in stream_frames(
+        fake_results([0.0] * 100, counter), prefetch=prefetch
+    ):
+        frames.append(frame)
+        if len(frames) == 1:
+            await asyncio.sleep(0.2)  # the producer could finish meanwhile
+            consumed = len(split_results(frames))
+            assert counter["produced"] <= consumed + prefetch + 1, counter
+    assert split_results(frames) == [f"result {i}\n" for i in range(100)]
+    print(
+        f"{len(frames)} frames for 100 results, with at most {prefetch} buffered"
     )
 
 
@@ -12,11 +12,17 @@
 
 # ## Basic setup
 
+import asyncio
+import collections
+import hashlib
 import io
 import os
+import random
+import re
+from pathlib import Path
 from typing import Optional
 
-from modal import Image, Secret, Stub, web_endpoint
+from modal import Image, Secret, Stub, Volume, method, web_endpoint
 
 # All Modal programs need a [`Stub`](/docs/reference/modal.Stub) — an object that acts as a recipe for
 # the application. Let's give it a friendly name.
@@ -83,36 +89,178 @@ image = (
     .run_function(fetch_model, secret=Secret.from_name("huggingface-secret"))
 )
 
-# ### The actual function
+# ### Caching images
+#
+# Every command gets a new random image by default. To get the same image again,
+# end the command with a seed, like `/sd oil painting of a shiba --seed 42`.
+# People tend to repeat slash commands, so we keep every image generated with a
+# seed in a persisted [`Volume`](/docs/reference/modal.Volume), under a hash of
+# the prompt, seed and number of steps that produced it. The same seeded request
+# always gives the same image, so a repeated command is answered straight from
+# the volume, without waking up a GPU. A negative seed means a random one, and
+# random images are never cached.
+
+IMAGES_PATH = Path("/images")
+RANDOM_SEED = -1
+DEFAULT_STEPS = 100
+
+stub.volume = Volume.persisted("stable-diff-slackbot-images")
+
+
+def image_path(prompt: str, seed: int, steps: int) -> Path:
+    key = hashlib.sha256(f"{prompt}\0{seed}\0{steps}".encode()).hexdigest()
+    return IMAGES_PATH / f"{key}.png"
+
+
+def parse_command(text: str) -> tuple[str, int]:
+    """Split a slash command's text into the prompt and an optional trailing seed."""
+    match = re.search(r"\s--seed[ =](\d+)\s*$", text)
+    if match is None:
+        return text.strip(), RANDOM_SEED
+    return text[: match.start()].strip(), int(match.group(1))
+
+
+# ### The model class
 #
 # Now that we have our token and `modal.Image` set up, we can put everything together.
 #
-# Let's define a function that takes a text prompt and an optional channel name
-# (so we can post results to Slack if the value is set) and runs stable diffusion.
-# The `@stub.function()` decorator declares all the resources this function will
+# The `@stub.cls()` decorator declares all the resources the model will
 # use: we configure it to use a GPU, run on an image that has all the packages and files we
 # need to run the model, and
 # also provide it the secret that contains the token we created above.
+#
+# The pipeline is loaded once per container, in `__enter__`. Each container takes
+# several requests at once: they wait in a queue, and a background task runs
+# everything that is waiting, with the same number of steps, through the pipeline
+# as one batch. Identical seeded requests that arrive together share one generation.
 
+MAX_BATCH_SIZE = 4
 
-@stub.function(
+
+@stub.cls(
     gpu="A10G",
     image=image,
     secret=Secret.from_name("huggingface-secret"),
+    volumes={IMAGES_PATH: stub.volume},
+    allow_concurrent_inputs=2 * MAX_BATCH_SIZE,
 )
-async def run_stable_diffusion(prompt: str, channel_name: Optional[str] = None):
-    pipe = fetch_model(local_files_only=True)
+class StableDiffusion:
+    def __enter__(self):
+        self.pipe = fetch_model(local_files_only=True)
+        self.queue: Optional[asyncio.Queue] = None
+        self.batch_task: Optional[asyncio.Task] = None
+        self.pending: dict[Path, asyncio.Future] = {}
+
+    def run_batch(self, requests: list[tuple[str, int, int]]) -> list[bytes]:
+        import torch
+
+        prompts = [prompt for prompt, _, _ in requests]
+        generators = [
+            torch.Generator("cuda").manual_seed(
+                seed if seed >= 0 else random.randrange(2**32)
+            )
+            for _, seed, _ in requests
+        ]
+        images = self.pipe(
+            prompts, num_inference_steps=requests[0][2], generator=generators
+        ).images
+
+        # Convert PIL Images to PNG byte arrays, and save seeded ones to the cache.
+        results = []
+        for request, image in zip(requests, images):
+            with io.BytesIO() as buf:
+                image.save(buf, format="PNG")
+                results.append(buf.getvalue())
+            if request[1] >= 0:
+                image_path(*request).write_bytes(results[-1])
+        if any(seed >= 0 for _, seed, _ in requests):
+            stub.volume.commit()
+        return results
+
+    async def run_batches(self):
+        assert self.queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            waiting = [await self.queue.get()]
+            while not self.queue.empty():
+                waiting.append(self.queue.get_nowait())
+            by_steps = collections.defaultdict(list)
+            for request, future in waiting:
+                by_steps[request[2]].append((request, future))
+            for group in by_steps.values():
+                for start in range(0, len(group), MAX_BATCH_SIZE):
+                    batch = group[start : start + MAX_BATCH_SIZE]
+                    try:
+                        results = await loop.run_in_executor(
+                            None, self.run_batch, [r for r, _ in batch]
+                        )
+                    except Exception as exc:
+                        for _, future in batch:
+                            future.set_exception(exc)
+                        continue
+                    for (_, future), result in zip(batch, results):
+                        future.set_result(result)
+
+    async def submit(self, request: tuple[str, int, int]) -> asyncio.Future:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.batch_task is None or self.batch_task.done():
+            self.batch_task = asyncio.create_task(self.run_batches())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return future
+
+    @method()
+    async def generate(self, prompt: str, seed: int, steps: int) -> bytes:
+        if seed < 0:
+            return await (await self.submit((prompt, seed, steps)))
+        path = image_path(prompt, seed, steps)
+        if path.exists():
+            return path.read_bytes()
+        if path not in self.pending:
+            future = await self.submit((prompt, seed, steps))
+            self.pending[path] = future
+            future.add_done_callback(lambda _: self.pending.pop(path, None))
+        return await asyncio.shield(self.pending[path])
 
-    image = pipe(prompt, num_inference_steps=100).images[0]
 
-    # Convert PIL Image to PNG byte array.
-    with io.BytesIO() as buf:
-        image.save(buf, format="PNG")
-        img_bytes = buf.getvalue()
+# ### The actual function
+#
+# Let's define a function that takes a text prompt and an optional channel name
+# (so we can post results to Slack if the value is set) and returns an image.
+# It runs on a CPU, and only calls the model if the image isn't cached yet.
+# Other containers may have added images since this one started, so we reload
+# the volume to see them first.
+
+
+@stub.function(
+    image=Image.debian_slim().pip_install("slack-sdk", "aiohttp"),
+    secret=Secret.from_name("stable-diff-slackbot-secret"),
+    volumes={IMAGES_PATH: stub.volume},
+    allow_concurrent_inputs=20,
+)
+async def run_stable_diffusion(
+    prompt: str,
+    channel_name: Optional[str] = None,
+    seed: int = RANDOM_SEED,
+    steps: int = DEFAULT_STEPS,
+):
+    path = image_path(prompt, seed, steps)
+    if seed >= 0 and not path.exists():
+        try:
+            await stub.volume.reload.aio()
+        except Exception as exc:  # e.g. if another input has a file open
+            print(f"Couldn't reload the image cache: {exc}")
+    if seed >= 0 and path.exists():
+        img_bytes = path.read_bytes()
+    else:
+        img_bytes = await StableDiffusion().generate.remote.aio(
+            prompt, seed, steps
+        )
 
     if channel_name:
         # `post_image_to_slack` is implemented further below.
-        post_image_to_slack.remote(prompt, channel_name, img_bytes)
+        await post_image_to_slack(prompt, channel_name, img_bytes)
 
     return img_bytes
 
@@ -143,8 +291,8 @@ from fastapi import Request
 @web_endpoint(method="POST")
 async def entrypoint(request: Request):
     body = await request.form()
-    prompt = body["text"]
-    run_stable_diffusion.spawn(prompt, body["channel_name"])
+    prompt, seed = parse_command(body["text"])
+    run_stable_diffusion.spawn(prompt, body["channel_name"], seed)
     return f"Running stable diffusion for {prompt}."
 
 
@@ -160,18 +308,27 @@ async def entrypoint(request: Request):
 #
 # ![create a slack secret](./slack_secret.png)
 #
-# Below, we use the secret and `slack-sdk` to post to a Slack channel.
+# Below, we use the secret and `slack-sdk` to post to a Slack channel. The
+# upload runs asynchronously, on a client that each container creates once and
+# reuses, so uploads share its pool of connections to Slack.
 
+slack_client = None
 
-@stub.function(
-    image=Image.debian_slim().pip_install("slack-sdk"),
-    secret=Secret.from_name("stable-diff-slackbot-secret"),
-)
-def post_image_to_slack(title: str, channel_name: str, image_bytes: bytes):
-    import slack_sdk
 
-    client = slack_sdk.WebClient(token=os.environ["SLACK_BOT_TOKEN"])
-    client.files_upload(channels=channel_name, title=title, content=image_bytes)
+async def post_image_to_slack(
+    title: str, channel_name: str, image_bytes: bytes
+):
+    global slack_client
+    import aiohttp
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    if slack_client is None:
+        slack_client = AsyncWebClient(
+            token=os.environ["SLACK_BOT_TOKEN"], session=aiohttp.ClientSession()
+        )
+    await slack_client.files_upload(
+        channels=channel_name, title=title, content=image_bytes
+    )
 
 
 # ## Deploy the Slackbot
@@ -205,9 +362,10 @@ def post_image_to_slack(title: str, channel_name: str, image_bytes: bytes):
 def run(
     prompt: str = "oil painting of a shiba",
     output_dir: str = "/tmp/stable-diffusion",
+    seed: int = RANDOM_SEED,
 ):
     os.makedirs(output_dir, exist_ok=True)
-    img_bytes = run_stable_diffusion.remote(prompt)
+    img_bytes = run_stable_diffusion.remote(prompt, seed=seed)
     output_path = os.path.join(output_dir, "output.png")
     with open(output_path, "wb") as f:
         f.write(img_bytes)
@@ -1,11 +1,15 @@
 # ---
 # args: ["--prompt", "test prompt for symon"]
 # ---
+import time
+
 import modal
 
 stub = modal.Stub("example-gpt2")
 
 CACHE_PATH = "/root/model_cache"
+MIN_NEW_TOKENS = 40
+MAX_NEW_TOKENS = 200
 
 
 # Run as a build function to save the model files into the custom `modal.Image`.
@@ -16,23 +20,117 @@ def download_model():
     generator.save_pretrained(CACHE_PATH)
 
 
-@stub.function(
+# The model is loaded once per container, in `__enter__`, and reused by every
+# call that container serves. Each call takes a list of prompts and samples
+# completions for all of them in one batch. GPT-2 has no padding token, so we
+# pad with the end-of-text token, on the left, so that every prompt in the
+# batch ends right where generation starts.
+
+
+@stub.cls(
     image=modal.Image.debian_slim()
     .pip_install("torch", "transformers")
     .run_function(download_model),
 )
-def generate_text(prompt: str):
-    from transformers import pipeline
+class GPT2:
+    def __enter__(self):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            CACHE_PATH, padding_side="left"
+        )
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(CACHE_PATH)
+        self.model.eval()
+
+    def _generate_kwargs(self, inputs):
+        return dict(
+            **inputs,
+            do_sample=True,
+            min_new_tokens=MIN_NEW_TOKENS,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=self.tokenizer.eos_token_id,
+        )
+
+    @modal.method()
+    def generate(self, prompts: list[str]) -> list[str]:
+        import torch
+
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        with torch.inference_mode():
+            outputs = self.model.generate(**self._generate_kwargs(inputs))
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    # The streaming variant samples a single prompt and yields the text as it
+    # is generated. Call it with `GPT2().generate_stream.remote_gen(prompt)`.
+
+    @modal.method()
+    def generate_stream(self, prompt: str):
+        from threading import Thread
 
-    # NOTE: This model load runs on every function invocation. It's more efficient
-    # to use lifecycle methods: modal.com/docs/guide/lifecycle-functions#container-lifecycle-beta.
-    generator = pipeline("text-generation", model=CACHE_PATH)
-    return generator(prompt, do_sample=True, min_length=50, max_length=250)[0][
-        "generated_text"
-    ]
+        from transformers import TextIteratorStreamer
+
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_special_tokens=True
+        )
+        inputs = self.tokenizer([prompt], return_tensors="pt")
+        thread = Thread(
+            target=self.model.generate,
+            kwargs=dict(**self._generate_kwargs(inputs), streamer=streamer),
+        )
+        thread.start()
+        yield from streamer
+        thread.join()
+
+
+# ## Benchmark
+#
+# `modal run gpt2_language_model.py --benchmark` measures the latency of the first
+# call and of later calls, and throughput at several batch sizes. The first call
+# includes starting a container and loading the model only if no container of
+# this app is still running, so it is labelled "first call", not "cold start".
+
+
+def run_benchmark(batch_sizes: str, repeats: int):
+    model = GPT2()
+    prompt = "Show me the meaning of"
+
+    t0 = time.monotonic()
+    model.generate.remote([prompt])
+    print(f"first call: {time.monotonic() - t0:.2f}s")
+
+    t0 = time.monotonic()
+    for _ in range(repeats):
+        model.generate.remote([prompt])
+    print(f"later calls: {(time.monotonic() - t0) / repeats:.2f}s")
+
+    for batch_size in map(int, batch_sizes.split(",")):
+        t0 = time.monotonic()
+        for _ in range(repeats):
+            model.generate.remote([prompt] * batch_size)
+        elapsed = time.monotonic() - t0
+        print(
+            f"batch size {batch_size:3d}: "
+            f"{batch_size * repeats / elapsed:.2f} prompts/s"
+        )
 
 
 @stub.local_entrypoint()
-def main(prompt: str = ""):
-    generation = generate_text.remote(prompt=prompt or "Show me the meaning of")
-    print(generation)
+def main(
+    prompt: str = "",
+    stream: bool = False,
+    benchmark: bool = False,
+    batch_sizes: str = "1,4,16",
+    repeats: int = 3,
+):
+    if benchmark:
+        run_benchmark(batch_sizes, repeats)
+        return
+
+    prompt = prompt or "Show me the meaning of"
+    if stream:
+        for text in GPT2().generate_stream.remote_gen(prompt):
+            print(text, end="", flush=True)
+        print()
+    else:
+        print(GPT2().generate.remote([prompt])[0])